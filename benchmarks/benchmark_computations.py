@@ -0,0 +1,115 @@
+"""Compare the NumPy computations of plotting/computations.py and
+convert_units of plotting/utils.py (FAST_COMPUTATIONS=true) with the MetPy
+ones they replace, in time and in values, on synthetic float32 fields of
+the size of the ICON-D2 grid, e.g.
+
+    python benchmarks/benchmark_computations.py --steps 4 --repeat 3
+
+MetPy is called on pint quantities like the computations do, and the unit
+conversions compare convert_units with FAST_COMPUTATIONS=false (MetPy) and
+true. The fast version is checked to return float32 and to differ from MetPy
+by less than the tolerance of every computation, the rounding of float32.
+The script exits with an error if a check fails."""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+home_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+os.environ.setdefault('MAPBOX_KEY', '')
+sys.path.insert(0, os.path.join(home_folder, 'plotting'))
+import xarray as xr
+import metpy.calc as mpcalc
+from metpy.units import units
+import utils
+from computations import fast_geopotential_height, fast_thetae, fast_wind_speed
+
+
+def fields(shape, seed=0):
+    """Synthetic float32 inputs in K, %, m2 s-2, m/s and Pa"""
+    random = np.random.RandomState(seed)
+    def field(low, high):
+        return random.uniform(low, high, shape).astype(np.float32)
+    return {'t': field(240., 310.), 'r': field(1., 100.), 'z': field(0., 60000.),
+            'u': field(-40., 40.), 'v': field(-40., 40.), 'prmsl': field(95000., 105000.)}
+
+
+def timed(function, repeat):
+    """Result of function and best time over repeat calls"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def magnitude(quantity):
+    return np.asarray(getattr(quantity, 'magnitude', quantity))
+
+
+def converted(values, source, target, fast):
+    """values converted by convert_units, with FAST_COMPUTATIONS=fast"""
+    utils.fast_computations = fast
+    data = xr.DataArray(values.copy(), attrs={'units': source})
+    utils.convert_units(data, target)
+    return data.values
+
+
+def computations(f):
+    """(name, MetPy, fast, tolerance) of every computation"""
+    return [
+        ('geopotential height (m)',
+         lambda: magnitude(mpcalc.geopotential_to_height(f['z'] * units('m**2/s**2')).to('m')),
+         lambda: fast_geopotential_height(f['z']), 1e-2),
+        ('theta-e 850 hPa (K)',
+         lambda: magnitude(mpcalc.equivalent_potential_temperature(
+             850. * units.hPa, f['t'] * units.K,
+             mpcalc.dewpoint_from_relative_humidity(f['t'] * units.K,
+                                                    f['r'] / 100. * units.dimensionless)).to('K')),
+         lambda: fast_thetae(f['t'], f['r'], 850.), 5e-3),
+        ('wind speed (km/h)',
+         lambda: magnitude(mpcalc.wind_speed(f['u'] * units('m/s'), f['v'] * units('m/s')).to('kph')),
+         lambda: fast_wind_speed(f['u'], f['v']), 1e-3),
+        ('K to degC',
+         lambda: converted(f['t'], 'K', 'degC', False),
+         lambda: converted(f['t'], 'K', 'degC', True), 1e-3),
+        ('Pa to hPa',
+         lambda: converted(f['prmsl'], 'Pa', 'hPa', False),
+         lambda: converted(f['prmsl'], 'Pa', 'hPa', True), 1e-3),
+        ('m/s to km/h',
+         lambda: converted(f['u'], 'm s**-1', 'kph', False),
+         lambda: converted(f['u'], 'm s**-1', 'kph', True), 1e-3),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--steps', help='Number of time steps of every field',
+                        required=False, default=4, type=int)
+    parser.add_argument('--nlat', help='Number of latitudes, 746 on the ICON-D2 grid',
+                        required=False, default=746, type=int)
+    parser.add_argument('--nlon', help='Number of longitudes, 1215 on the ICON-D2 grid',
+                        required=False, default=1215, type=int)
+    parser.add_argument('--repeat', help='Best time of this many calls',
+                        required=False, default=3, type=int)
+    args = parser.parse_args()
+
+    f = fields((args.steps, args.nlat, args.nlon))
+    print('%d x %d x %d float32 points, best of %d' % (args.steps, args.nlat, args.nlon, args.repeat))
+    print('%-26s %10s %10s %8s %10s %8s' % ('computation', 'metpy s', 'numpy s', 'speedup',
+                                            'max diff', 'dtype'))
+    failed = []
+    for name, reference, fast, tolerance in computations(f):
+        expected, reference_time = timed(reference, args.repeat)
+        result, fast_time = timed(fast, args.repeat)
+        difference = float(np.nanmax(np.abs(result.astype(np.float64) - expected)))
+        print('%-26s %10.3f %10.3f %7.1fx %10.2e %8s' % (name, reference_time, fast_time,
+                                                         reference_time / fast_time,
+                                                         difference, result.dtype))
+        if difference > tolerance or result.dtype != np.float32:
+            failed.append(name)
+    if failed:
+        print('Failed: %s' % ', '.join(failed))
+        sys.exit(1)
@@ -0,0 +1,160 @@
+"""Measure the throughput of the download stage (listing -> download ->
+decompress -> merge) against the local mirror of dwd_mirror.py, so that
+concurrency settings can be compared reproducibly, e.g.
+
+    python benchmarks/benchmark_download.py --workers 4 8 16 --decompress_workers 2 4 \
+        --latency 0.05 --bandwidth 20 --failure_rate 0.02 --repeat 3 --output results.json
+
+Every combination of the settings is run repeat times, each time in an empty
+folder and with an empty listing cache. The listings are parsed by
+listing_cache.get_hrefs, which is also what listurls in
+functions_download_dwd.sh uses, and the merging is done by ingest.py."""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+home_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, home_folder)
+import listing_cache
+import download_dwd
+from download_dwd import Manifest, ConcurrencyController, list_files, download_files
+from ingest import ingest_variable
+from listing_cache import get_session
+from dwd_mirror import DWDMirror
+
+
+def run_once(mirror, workers, decompress_workers, mode='adaptive', retries=3, backoff=0.1):
+    """Download and merge all the variables of the mirror once, returning
+    the timings of every stage. In adaptive mode workers is the maximum
+    number of concurrent downloads."""
+    folder = tempfile.mkdtemp(prefix='benchmark_download_')
+    listing_cache.cache_folder = os.path.join(folder, 'listing_cache')
+    download_dwd.base_url = mirror.url
+    mirror.reset_stats()
+    try:
+        session = get_session(pool_size=workers)
+        manifest = Manifest(mirror.run, folder)
+        variables = [(var, kind) for var, kind in mirror.variables.items() if kind != 'invariant']
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            listings = list(executor.map(lambda v: list_files(v[0], v[1], mirror.run, session),
+                                         variables))
+        for (var, _), listing in zip(variables, listings):
+            manifest.add_variable(var, listing)
+        list_time = time.time() - start
+
+        controller = None
+        if mode == 'adaptive':
+            controller = ConcurrencyController(maximum=workers, verbose=False)
+        start = time.time()
+        records = download_files([url for listing in listings for url in listing], folder,
+                                 workers, decompress_workers, retries, backoff, session, manifest,
+                                 controller=controller)
+        download_time = time.time() - start
+
+        start = time.time()
+        for var, _ in variables:
+            if manifest.check_variable(var, checksum=False):
+                continue
+            ingest_variable(var, mirror.run,
+                            [os.path.join(folder, name) for name in manifest.variables[var]],
+                            folder)
+        merge_time = time.time() - start
+    finally:
+        shutil.rmtree(folder)
+
+    downloaded = [r for r in records if r['status'] == 'downloaded']
+    compressed_bytes = sum(r['compressed_bytes'] for r in downloaded)
+    elapsed = list_time + download_time + merge_time
+    return {
+        'mode': mode,
+        'workers': workers,
+        'final_workers': int(controller.limit) if controller else workers,
+        'decisions': controller.decisions if controller else [],
+        'decompress_workers': decompress_workers,
+        'files': len(records),
+        'failed': sum(r['status'] == 'failed' for r in records),
+        'retries': sum(r['attempts'] - 1 for r in downloaded),
+        'compressed_bytes': compressed_bytes,
+        'list_time': list_time,
+        'download_time': download_time,
+        'merge_time': merge_time,
+        'elapsed': elapsed,
+        'throughput_mbps': compressed_bytes * 8 / 1e6 / elapsed,
+        'server': dict(mirror.stats),
+    }
+
+
+def print_results(results):
+    print('%8s %8s %6s %8s %6s %6s %8s %8s %8s %8s %8s %10s' %
+          ('mode', 'workers', 'final', 'decompr', 'files', 'failed', 'retries', 'list',
+           'download', 'merge', 'total', 'Mbit/s'))
+    for r in results:
+        print('%8s %8d %6d %8d %6d %6d %8d %8.2f %8.2f %8.2f %8.2f %10.1f' %
+              (r['mode'], r['workers'], r['final_workers'], r['decompress_workers'],
+               r['files'], r['failed'], r['retries'],
+               r['list_time'], r['download_time'], r['merge_time'], r['elapsed'],
+               r['throughput_mbps']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run served by the mirror (YYYYMMDDHH)',
+                        required=False, default='2021010100')
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables',
+                        required=False, default=['t_2m', 'pmsl', 'tot_prec'], nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables',
+                        required=False, default=['t', 'fi'], nargs='+')
+    parser.add_argument('--levels', help='Pressure levels (hPa) of the 3d variables',
+                        required=False, default=[500, 850], nargs='+', type=int)
+    parser.add_argument('-s', '--steps', help='Number of forecast steps',
+                        required=False, default=49, type=int)
+    parser.add_argument('-g', '--grid', help='Number of points in longitude and latitude',
+                        required=False, default=[122, 75], nargs=2, type=int)
+    parser.add_argument('-l', '--latency', help='Seconds added to every request',
+                        required=False, default=0.02, type=float)
+    parser.add_argument('-b', '--bandwidth', help='Total bandwidth cap in MB/s',
+                        required=False, default=None, type=float)
+    parser.add_argument('--connection_bandwidth', help='Bandwidth cap of every connection in MB/s',
+                        required=False, default=None, type=float)
+    parser.add_argument('--failure_rate', help='Fraction of the file requests which fail',
+                        required=False, default=0., type=float)
+    parser.add_argument('--max_in_flight', help='The mirror refuses with 429 the requests beyond this number of concurrent ones',
+                        required=False, default=None, type=int)
+    parser.add_argument('-m', '--modes', help='Compare adaptive concurrency (workers is the maximum) and fixed concurrency',
+                        required=False, default=['adaptive', 'fixed'], nargs='+', choices=['adaptive', 'fixed'])
+    parser.add_argument('-w', '--workers', help='Numbers of concurrent downloads to compare',
+                        required=False, default=[4, 8, 16], nargs='+', type=int)
+    parser.add_argument('-d', '--decompress_workers', help='Numbers of decompression threads to compare',
+                        required=False, default=[4], nargs='+', type=int)
+    parser.add_argument('-n', '--repeat', help='Number of runs of every combination',
+                        required=False, default=1, type=int)
+    parser.add_argument('-o', '--output', help='Save all the results as JSON to this file',
+                        required=False, default=None)
+    args = parser.parse_args()
+
+    mirror = DWDMirror(args.run, args.vars_2d, args.vars_3d, args.levels, invariants=[],
+                       steps=args.steps, grid=tuple(args.grid), latency=args.latency,
+                       bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+                       connection_bandwidth=args.connection_bandwidth * 1e6 if args.connection_bandwidth else None,
+                       failure_rate=args.failure_rate, max_in_flight=args.max_in_flight)
+    # Generate all the files before, so that the first run is not slower
+    for var in mirror.variables:
+        mirror.listing(args.run[8:], var)
+    results = []
+    with mirror:
+        for mode, workers, decompress_workers in itertools.product(args.modes, args.workers,
+                                                                   args.decompress_workers):
+            for _ in range(args.repeat):
+                results.append(run_once(mirror, workers, decompress_workers, mode))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=1)
@@ -0,0 +1,216 @@
+"""Measure the memory used by the plotting jobs (every product on every
+projection, as copy_data.run runs them with parallel) when read_dataset reads
+the run from the compressed NETCDF4 store and when it memory maps the
+uncompressed NETCDF3 store (read_dataset(mmap=True)), e.g.
+
+    python benchmarks/benchmark_read_memory.py --resolution 0.04 --jobs 4 --output memory.json
+
+A synthetic run with all the inputs of the products is written by the
+OutputWriter of ingest.py and consolidated by store.py in both formats. Every
+job is a separate process which reads its inputs like the plotting script,
+loads them and touches every value, then reports its memory from
+/proc/self/smaps_rollup: Rss counts the pages of the page cache which are
+mapped by the process, Pss divides the shared pages among the processes
+mapping them, and Anonymous is the private memory which is not backed by a
+file, i.e. the copies of the data. The plotting itself is not done.
+With --pack the variables are stored as int16 like ingest.py --pack does,
+which halves the files but makes the jobs decode (copy) them even when they
+are memory mapped."""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+home_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, home_folder)
+from products import products, get_product, product_levels, plan_fetch, pressure_levels, \
+    variable_kind
+
+# Extent of the ICON-D2 regular lat-lon grid
+domain = {'lon': (-3.94, 20.34), 'lat': (43.18, 58.08)}
+
+# Units of the variables as they are decoded from the DWD files and range of
+# their synthetic values, inside the packed_ranges of ingest.py
+synthetic_fields = {
+    't_2m': ('K', 250., 310.),
+    'td_2m': ('K', 240., 300.),
+    'tmax_2m': ('K', 250., 315.),
+    'tmin_2m': ('K', 245., 305.),
+    't': ('K', 210., 300.),
+    'pmsl': ('Pa', 97000., 104000.),
+    'clcl': ('%', 0., 100.),
+    'clch': ('%', 0., 100.),
+    'relhum': ('%', 0., 100.),
+    'u': ('m s**-1', -40., 40.),
+    'v': ('m s**-1', -40., 40.),
+    'u_10m': ('m s**-1', -20., 20.),
+    'v_10m': ('m s**-1', -20., 20.),
+    'vmax_10m': ('m s**-1', 0., 40.),
+    'fi': ('m**2 s**-2', 0., 120000.),
+    'cape_ml': ('J kg**-1', 0., 3000.),
+    'cin_ml': ('J kg**-1', -500., 0.),
+    'h_snow': ('m', 0., 2.),
+    'snowlmt': ('m', 0., 4000.),
+    'dbz_cmax': ('dBZ', -30., 60.),
+    'synmsg_bt_cl_ir10.8': ('K', 200., 300.),
+    'hsurf': ('m', 0., 3000.),
+    'tot_prec': ('kg m**-2', 0., 50.),
+    'rain_gsp': ('kg m**-2', 0., 50.),
+    'snow_gsp': ('kg m**-2', 0., 20.),
+    'ww': ('Numeric', 0., 99.),
+}
+
+
+def memory_usage():
+    """Rss, Pss and Anonymous memory of this process in MB"""
+    usage = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'Anonymous'):
+                usage[key.lower()] = int(value.split()[0]) / 1024.
+    return usage
+
+
+def write_run(folder, run, resolution, steps, seed=0, pack=False):
+    """Write the merged files of all the inputs of the products with the
+    OutputWriter of ingest.py, which registers them in the catalog, packed
+    as int16 if pack"""
+    from ingest import OutputWriter
+    lon = np.arange(domain['lon'][0], domain['lon'][1], resolution)
+    lat = np.arange(domain['lat'][0], domain['lat'][1], resolution)
+    x, y = np.meshgrid(np.linspace(0, 4 * np.pi, len(lon)), np.linspace(0, 3 * np.pi, len(lat)))
+    noise = np.random.RandomState(seed).normal(scale=0.05, size=x.shape)
+    plan = plan_fetch()
+    variables = [(var, None) for var in plan['2d']] + \
+        [(var, levels or pressure_levels) for var, levels in plan['3d'].items()] + \
+        [(var.upper(), None) for var in plan['invariant']]
+    start = datetime.strptime(run, '%Y%m%d%H')
+    for var, levels in variables:
+        units, low, high = synthetic_fields[var.lower()]
+        writer = OutputWriter(var, run, folder, pack=pack)
+        for step in range(1 if variable_kind(var) == 'invariant' else steps):
+            values = 0.5 + 0.45 * np.sin(x + step / 6.) * np.cos(y) + noise / 10.
+            values = (low + (high - low) * np.clip(values, 0., 1.)).astype(np.float32)
+            writer.write_step([{'values': values, 'lat': lat, 'lon': lon, 'long_name': var,
+                                'units': units, 'time': start + timedelta(hours=step),
+                                'level': None if levels is None else level * 100}
+                               for level in (levels or [None])])
+        writer.close()
+    return len(lat), len(lon)
+
+
+def run_job(script, projection, folder, mmap):
+    """Read the inputs of script like the script does, in this process"""
+    os.environ['MODEL_DATA_FOLDER'] = folder + '/'
+    os.environ.setdefault('MAPBOX_KEY', '')
+    sys.path.insert(0, os.path.join(home_folder, 'plotting'))
+    from utils import read_dataset
+    baseline = memory_usage()
+    start = time.time()
+    product = get_product(script)
+    levels = sorted(set(l for var in product['variables'] if variable_kind(var) == '3d'
+                        for l in product_levels(product, var) or []), reverse=True)
+    dset = read_dataset(variables=product['variables'],
+                        level=[l * 100 for l in levels] or None,
+                        projection=projection, freq=None, mmap=mmap)
+    dset = dset.load()
+    # Touch every value, as the plots do
+    checksum = sum(float(np.nansum(dset[var].values)) for var in dset.data_vars if var != 'run')
+    usage = memory_usage()
+    result = dict(usage, read_time=time.time() - start, checksum=checksum)
+    for k in usage:
+        result['%s_data' % k] = usage[k] - baseline[k]
+    return result
+
+
+def run_jobs(jobs, folder, mmap, concurrency):
+    """Run every (script, projection) job in its own process, concurrency of
+    them at the same time like parallel -j does"""
+    def launch(job):
+        command = [sys.executable, os.path.realpath(__file__), '--job', job[0], job[1],
+                   '--folder', folder] + (['--mmap'] if mmap else [])
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        return dict(json.loads(output.splitlines()[-1]), script=job[0], projection=job[1])
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(launch, jobs))
+    return results, time.time() - start
+
+
+def print_results(summary):
+    print('%6s %5s %10s %10s %10s %10s %10s %10s' %
+          ('mode', 'jobs', 'rss', 'pss', 'anonymous', 'data anon', 'max anon', 'time'))
+    for s in summary:
+        print('%6s %5d %10.0f %10.0f %10.0f %10.0f %10.0f %10.1f' %
+              (s['mode'], s['jobs'], s['rss'], s['pss'], s['anonymous'], s['anonymous_data'],
+               s['max_anonymous'], s['elapsed']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run of the synthetic data (YYYYMMDDHH)',
+                        required=False, default='2021010100')
+    parser.add_argument('--resolution', help='Grid spacing in degrees, ICON-D2 is 0.02',
+                        required=False, default=0.04, type=float)
+    parser.add_argument('-s', '--steps', help='Number of forecast steps',
+                        required=False, default=49, type=int)
+    parser.add_argument('-p', '--products', help='Products to read, all the maps by default',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('-j', '--jobs', help='Number of jobs running at the same time',
+                        required=False, default=4, type=int)
+    parser.add_argument('--pack', help='Store the variables of packed_ranges in ingest.py as int16',
+                        required=False, action='store_true')
+    parser.add_argument('-o', '--output', help='Save all the results as JSON to this file',
+                        required=False, default=None)
+    parser.add_argument('--job', help=argparse.SUPPRESS, required=False, default=None, nargs=2)
+    parser.add_argument('--folder', help=argparse.SUPPRESS, required=False, default=None)
+    parser.add_argument('--mmap', help=argparse.SUPPRESS, required=False, action='store_true')
+    args = parser.parse_args()
+
+    if args.job:
+        print(json.dumps(run_job(args.job[0], args.job[1], args.folder, args.mmap)))
+        sys.exit(0)
+
+    from store import build_store
+    names = args.products or [name for name in products if get_product(name)['projections']]
+    jobs = [(name, projection) for name in names for projection in get_product(name)['projections']]
+    folder = tempfile.mkdtemp(prefix='benchmark_read_memory_')
+    summary, results = [], []
+    try:
+        for mode, fmt in (('read', 'NETCDF4'), ('mmap', 'NETCDF3_64BIT_OFFSET')):
+            mode_folder = os.path.join(folder, mode)
+            os.makedirs(mode_folder)
+            nlat, nlon = write_run(mode_folder, args.run, args.resolution, args.steps,
+                                   pack=args.pack)
+            build_store(args.run, mode_folder, remove=True, fmt=fmt)
+            # Same starting point for both modes: the store is in the page cache
+            with open(os.path.join(mode_folder, 'icon-d2_%s_store.nc' % args.run), 'rb') as f:
+                while f.read(1 << 24):
+                    pass
+            mode_results, elapsed = run_jobs(jobs, mode_folder, mode == 'mmap', args.jobs)
+            shutil.rmtree(mode_folder)
+            results += [dict(r, mode=mode) for r in mode_results]
+            summary.append(dict(mode=mode, jobs=len(mode_results), elapsed=elapsed,
+                                max_anonymous=max(r['anonymous'] for r in mode_results),
+                                **dict((k, np.mean([r[k] for r in mode_results]))
+                                       for k in ('rss', 'pss', 'anonymous', 'anonymous_data'))))
+    finally:
+        shutil.rmtree(folder)
+    print('%d jobs on a %dx%d grid with %d steps%s, %d at a time, mean memory per job in MB'
+          % (len(jobs), nlat, nlon, args.steps, ' (packed)' if args.pack else '', args.jobs))
+    print_results(summary)
+    saved = summary[0]['anonymous_data'] - summary[1]['anonymous_data']
+    print('Private memory saved by mmap: %.0f MB per job, %.0f MB with %d jobs at a time'
+          % (saved, saved * args.jobs, args.jobs))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'summary': summary, 'results': results}, f, indent=1)
@@ -0,0 +1,361 @@
+"""Local stand-in for the ICON-D2 part of the DWD opendata server, so that the
+download stage can be exercised and timed without hitting opendata.dwd.de.
+Directory listings are generated in the same format as the real server
+(with ETag/Last-Modified, so the listing cache works) and the files are
+synthetic but valid GRIB2 fields compressed with bz2, which ingest.py can
+decode. Latency, bandwidth caps and failures (5xx, 429, truncated responses,
+connection resets) can be injected. Start it with
+
+    python benchmarks/dwd_mirror.py --run 2021010100 --steps 6 --latency 0.05
+
+and point the download scripts to it with
+
+    export ICON_D2_URL=http://127.0.0.1:8000/weather/nwp/icon-d2/grib
+
+or use DWDMirror directly from Python (see benchmark_download.py)."""
+import bz2
+import sys
+import time
+import random
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import eccodes
+
+prefix = '/weather/nwp/icon-d2/grib'
+
+file_templates = {
+    '2d': "icon-d2_germany_regular-lat-lon_single-level_%s_%03d_2d_%s.grib2.bz2",
+    '3d': "icon-d2_germany_regular-lat-lon_pressure-level_%s_%03d_%d_%s.grib2.bz2",
+    'invariant': "icon-d2_germany_regular-lat-lon_time-invariant_%s_%03d_0_%s.grib2.bz2",
+}
+
+# Corner of the ICON-D2 regular grid, which has a resolution of 0.02 degrees
+first_lat, first_lon = 43.18, -3.94
+
+
+def make_grib(run, step, level=None, grid=(122, 75), resolution=0.2, seed=0):
+    """Synthetic GRIB2 message of run on a regular lat-lon grid of grid (ni, nj)
+    points starting at the corner of the ICON-D2 domain. The field is smooth
+    plus some noise, so that it compresses roughly like a real one."""
+    ni, nj = grid
+    sample = 'regular_ll_sfc_grib2' if level is None else 'regular_ll_pl_grib2'
+    gid = eccodes.codes_grib_new_from_samples(sample)
+    try:
+        eccodes.codes_set(gid, 'dataDate', int(run[:8]))
+        eccodes.codes_set(gid, 'dataTime', int(run[8:]) * 100)
+        eccodes.codes_set(gid, 'forecastTime', step)
+        if level is not None:
+            eccodes.codes_set(gid, 'level', level)
+        eccodes.codes_set(gid, 'Ni', ni)
+        eccodes.codes_set(gid, 'Nj', nj)
+        eccodes.codes_set(gid, 'latitudeOfFirstGridPointInDegrees', first_lat)
+        eccodes.codes_set(gid, 'longitudeOfFirstGridPointInDegrees', first_lon % 360)
+        eccodes.codes_set(gid, 'latitudeOfLastGridPointInDegrees', first_lat + (nj - 1) * resolution)
+        eccodes.codes_set(gid, 'longitudeOfLastGridPointInDegrees', (first_lon + (ni - 1) * resolution) % 360)
+        eccodes.codes_set(gid, 'iDirectionIncrementInDegrees', resolution)
+        eccodes.codes_set(gid, 'jDirectionIncrementInDegrees', resolution)
+        eccodes.codes_set(gid, 'jScansPositively', 1)
+        eccodes.codes_set(gid, 'bitsPerValue', 16)
+        x, y = np.meshgrid(np.linspace(0, 4 * np.pi, ni), np.linspace(0, 3 * np.pi, nj))
+        noise = np.random.RandomState(seed).normal(scale=0.05, size=x.shape)
+        values = 280. + 10. * np.sin(x + step / 6.) * np.cos(y) + noise
+        eccodes.codes_set_values(gid, values.ravel())
+        return eccodes.codes_get_message(gid)
+    finally:
+        eccodes.codes_release(gid)
+
+
+class TokenBucket(object):
+    """Bandwidth cap (bytes/s) shared between the threads which use it"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.available = 0.
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.time()
+            self.available = min(self.available + (now - self.last) * self.rate, self.rate)
+            self.last = now
+            self.available -= n
+            wait = -self.available / self.rate if self.available < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.mirror.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        mirror = self.server.mirror
+        try:
+            if mirror.enter():
+                self.handle_get(mirror)
+            else:
+                self.send_response(429)
+                self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                mirror.count('rate_limited')
+        finally:
+            mirror.leave()
+
+    def handle_get(self, mirror):
+        if mirror.latency:
+            time.sleep(mirror.latency)
+        path = self.path.split('?')[0]
+        if not path.startswith(prefix + '/'):
+            return self.send_status(404)
+        parts = path[len(prefix) + 1:].split('/')
+        if len(parts) == 3 and parts[2] == '':
+            listing = mirror.listing(parts[0], parts[1])
+            if listing is None:
+                return self.send_status(404)
+            return self.send_listing(mirror, listing)
+        if len(parts) == 3:
+            return self.send_file(mirror, parts[0], parts[1], parts[2])
+        return self.send_status(404)
+
+    def send_status(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.mirror.count('status_%d' % status)
+
+    def send_listing(self, mirror, listing):
+        names = sorted(listing)
+        etag = '"%s"' % hashlib.sha1(''.join(names).encode('utf-8')).hexdigest()[:16]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            mirror.count('listing_not_modified')
+            return
+        date = mirror.published.strftime('%d-%b-%Y %H:%M')
+        body = '<html>\r\n<head><title>Index of %s</title></head>\r\n<body>\r\n<pre><a href="../">../</a>\r\n' \
+               % self.path
+        body += ''.join('<a href="%s">%s</a> %s %d\r\n' % (name, name, date, listing[name])
+                        for name in names)
+        body += '</pre><hr></body>\r\n</html>\r\n'
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', format_datetime(mirror.published, usegmt=True))
+        self.end_headers()
+        self.wfile.write(body)
+        mirror.count('listings')
+
+    def send_file(self, mirror, run_hour, var, name):
+        content = mirror.content(run_hour, var, name)
+        if content is None:
+            return self.send_status(404)
+        failure = mirror.draw_failure()
+        if failure in ('503', '429'):
+            return self.send_status(int(failure))
+        if failure == 'reset':
+            mirror.count('resets')
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Last-Modified', format_datetime(mirror.published, usegmt=True))
+        self.end_headers()
+        if failure == 'truncate':
+            content = content[:len(content) // 2]
+            self.close_connection = True
+            mirror.count('truncated')
+        for i in range(0, len(content), mirror.chunk_size):
+            chunk = content[i:i + mirror.chunk_size]
+            for bucket in (mirror.bucket, self.connection_bucket(mirror)):
+                if bucket is not None:
+                    bucket.consume(len(chunk))
+            self.wfile.write(chunk)
+        mirror.count('files')
+        mirror.count('bytes', len(content))
+
+    def connection_bucket(self, mirror):
+        if not mirror.connection_bandwidth:
+            return None
+        if not hasattr(self, '_bucket'):
+            self._bucket = TokenBucket(mirror.connection_bandwidth)
+        return self._bucket
+
+
+class DWDMirror(object):
+    """Serve the files of run for the variables and steps 0..steps-1 on
+    host:port (a free port by default). bandwidth caps the total throughput
+    and connection_bandwidth the one of every connection (bytes/s),
+    a fraction failure_rate of the file requests fails with one of failures
+    drawn at random and requests beyond max_in_flight concurrent ones are
+    refused with 429, as a rate limiting server would do. Use it as a context manager or call start() and stop()."""
+
+    def __init__(self, run, vars_2d=['t_2m', 'pmsl'], vars_3d=['t'], levels=[500, 850],
+                 invariants=['hsurf'], steps=49, grid=(122, 75), latency=0., bandwidth=None,
+                 connection_bandwidth=None, failure_rate=0., failures=['503', '429', 'truncate', 'reset'],
+                 max_in_flight=None, seed=0, host='127.0.0.1', port=0, verbose=False):
+        self.run = run
+        self.variables = dict([(v, '2d') for v in vars_2d] + [(v, '3d') for v in vars_3d] +
+                              [(v, 'invariant') for v in invariants])
+        self.levels = levels
+        self.steps = steps
+        self.grid = grid
+        self.latency = latency
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.connection_bandwidth = connection_bandwidth
+        self.failure_rate = failure_rate
+        self.failures = failures
+        self.max_in_flight = max_in_flight
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.chunk_size = 2 ** 16
+        self.published = datetime.now(timezone.utc).replace(microsecond=0)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.in_flight = 0
+        self.cache = {}
+        self.server = ThreadingHTTPServer((host, port), MirrorHandler)
+        self.server.daemon_threads = True
+        self.server.mirror = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, prefix)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def enter(self):
+        """Count a new request, False if it is beyond max_in_flight"""
+        with self.lock:
+            self.in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats.get('max_in_flight', 0), self.in_flight)
+            self.stats['requests'] = self.stats.get('requests', 0) + 1
+            return self.max_in_flight is None or self.in_flight <= self.max_in_flight
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+    def draw_failure(self):
+        with self.lock:
+            if self.failures and self.random.random() < self.failure_rate:
+                return self.random.choice(self.failures)
+        return None
+
+    def files(self, var):
+        """Names of the files of var with their step and level"""
+        kind = self.variables[var]
+        if kind == 'invariant':
+            return [(file_templates[kind] % (self.run, 0, var), 0, None)]
+        if kind == '2d':
+            return [(file_templates[kind] % (self.run, step, var), step, None)
+                    for step in range(self.steps)]
+        return [(file_templates[kind] % (self.run, step, level, var), step, level)
+                for step in range(self.steps) for level in self.levels]
+
+    def listing(self, run_hour, var):
+        """Names and sizes of the files in the directory of var, None if it does not exist"""
+        if run_hour != self.run[8:] or var not in self.variables:
+            return None
+        return dict((name, len(self.content(run_hour, var, name)))
+                    for name, _, _ in self.files(var))
+
+    def content(self, run_hour, var, name):
+        if run_hour != self.run[8:] or var not in self.variables:
+            return None
+        for file_name, step, level in self.files(var):
+            if file_name == name:
+                break
+        else:
+            return None
+        # The same field is used for all the variables to save time
+        key = (step, level)
+        if key not in self.cache:
+            message = make_grib(self.run, step, level, self.grid, seed=step)
+            content = bz2.compress(message)
+            with self.lock:
+                self.cache[key] = content
+        return self.cache[key]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run to serve (YYYYMMDDHH)',
+                        required=False, default=datetime.utcnow().strftime('%Y%m%d00'))
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables',
+                        required=False, default=['t_2m', 'pmsl'], nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables',
+                        required=False, default=['t'], nargs='+')
+    parser.add_argument('--levels', help='Pressure levels (hPa) of the 3d variables',
+                        required=False, default=[500, 850], nargs='+', type=int)
+    parser.add_argument('-s', '--steps', help='Number of forecast steps',
+                        required=False, default=49, type=int)
+    parser.add_argument('-g', '--grid', help='Number of points in longitude and latitude',
+                        required=False, default=[122, 75], nargs=2, type=int)
+    parser.add_argument('-l', '--latency', help='Seconds added to every request',
+                        required=False, default=0., type=float)
+    parser.add_argument('-b', '--bandwidth', help='Total bandwidth cap in MB/s',
+                        required=False, default=None, type=float)
+    parser.add_argument('--connection_bandwidth', help='Bandwidth cap of every connection in MB/s',
+                        required=False, default=None, type=float)
+    parser.add_argument('--failure_rate', help='Fraction of the file requests which fail',
+                        required=False, default=0., type=float)
+    parser.add_argument('--failures', help='Kinds of failures which are injected',
+                        required=False, default=['503', '429', 'truncate', 'reset'], nargs='+',
+                        choices=['503', '429', 'truncate', 'reset'])
+    parser.add_argument('--max_in_flight', help='Refuse with 429 the requests beyond this number of concurrent ones',
+                        required=False, default=None, type=int)
+    parser.add_argument('-p', '--port', help='Port to listen on',
+                        required=False, default=8000, type=int)
+    parser.add_argument('--verbose', help='Log every request',
+                        required=False, action='store_true')
+    args = parser.parse_args()
+
+    mirror = DWDMirror(args.run, args.vars_2d, args.vars_3d, args.levels, steps=args.steps,
+                       grid=tuple(args.grid), latency=args.latency,
+                       bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+                       connection_bandwidth=args.connection_bandwidth * 1e6 if args.connection_bandwidth else None,
+                       failure_rate=args.failure_rate, failures=args.failures,
+                       max_in_flight=args.max_in_flight, port=args.port, verbose=args.verbose)
+    print('Serving run %s on %s' % (args.run, mirror.url))
+    sys.stdout.flush()
+    try:
+        mirror.server.serve_forever()
+    except KeyboardInterrupt:
+        mirror.server.server_close()
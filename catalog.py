@@ -0,0 +1,148 @@
+"""Catalog of the runs in the data folder (catalog.json), written at ingest.
+Every variable of a run is mapped to the file which contains it, the name of
+the NetCDF variable, its pressure levels, its time axis and its bounding box:
+
+    {"runs": {"2021010100": {"variables": {"t": {"file": "t_2021010100_de.nc",
+        "name": "t", "format": "NETCDF3_64BIT_OFFSET", "levels": [85000.0, 50000.0],
+        "times": [1609459200.0, ...], "bbox": [lon_min, lon_max, lat_min, lat_max]}}}}}
+
+ingest.py registers every merged file it writes, with the entry of its
+hourly view in "hourly" when the variable has sub-hourly output, and
+store.py replaces them with the consolidated stores (adding "points" for
+the time-series store),
+read_dataset in plotting/utils.py resolves its inputs through the catalog
+instead of globbing the folder. Use
+
+    python catalog.py --check --products plot_cape.py plot_meteogram.py
+
+to verify that the run has all the inputs of the products."""
+import os
+import sys
+import json
+import fcntl
+import argparse
+from contextlib import contextmanager
+import netCDF4
+from download_dwd import get_run_from_env
+from products import plan_fetch, variable_kind
+
+catalog_name = 'catalog.json'
+
+
+def catalog_file(folder='.'):
+    return os.path.join(folder, catalog_name)
+
+
+def load_catalog(folder='.'):
+    path = catalog_file(folder)
+    if not os.path.isfile(path):
+        return {'runs': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+@contextmanager
+def locked(folder='.'):
+    """Serialize the updates of the catalog by the ingest processes"""
+    with open(catalog_file(folder) + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def update_catalog(folder, run, entries):
+    """Add (or replace) the entries of the variables of run. The catalog is
+    replaced atomically, so readers always see a complete one."""
+    path = catalog_file(folder)
+    with locked(folder):
+        catalog = load_catalog(folder)
+        variables = catalog['runs'].setdefault(run, {'variables': {}})['variables']
+        variables.update(entries)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(catalog, f, indent=1)
+        os.replace(path + '.tmp', path)
+    return catalog
+
+
+def file_entry(path, name=None):
+    """Catalog entry of the variable name of the NetCDF file path (the only
+    data variable by default)"""
+    with netCDF4.Dataset(path) as nc:
+        if name is None:
+            name = [v for v in nc.variables if v not in ('time', 'lat', 'lon', 'plev')][0]
+        var = nc[name]
+        lat, lon = nc['lat'][:], nc['lon'][:]
+        return {
+            'file': os.path.basename(path),
+            'name': name,
+            'format': nc.data_model,
+            'levels': nc['plev'][:].tolist() if 'plev' in var.dimensions else None,
+            'times': nc['time'][:].tolist() if 'time' in var.dimensions else None,
+            'bbox': [float(lon.min()), float(lon.max()), float(lat.min()), float(lat.max())],
+        }
+
+
+def register_file(path, var, run, hourly=None):
+    """Add the merged file of var written at ingest, and the file of its
+    hourly view if given, to the catalog"""
+    entry = file_entry(path)
+    if variable_kind(var) == 'invariant':
+        entry['times'] = None
+    if hourly is not None:
+        entry['hourly'] = file_entry(hourly)
+    update_catalog(os.path.dirname(path) or '.', run, {var.lower(): entry})
+
+
+def check_run(catalog, run, folder='.', products=None):
+    """Check that the files of run exist and contain the inputs of the
+    products (all of them by default). Returns a list of errors."""
+    if run not in catalog['runs']:
+        return ['Run %s is not in the catalog' % run]
+    variables = catalog['runs'][run]['variables']
+    errors = []
+    for var, entry in sorted(variables.items()):
+        for key in ('file', 'points'):
+            if key in entry and not os.path.isfile(os.path.join(folder, entry[key])):
+                errors.append('%s of %s does not exist' % (entry[key], var))
+        if 'hourly' in entry and not os.path.isfile(os.path.join(folder, entry['hourly']['file'])):
+            errors.append('%s of %s does not exist' % (entry['hourly']['file'], var))
+        if entry['times'] is not None and not entry['times']:
+            errors.append('%s has no time steps' % var)
+    plan = plan_fetch(products)
+    for var in plan['2d'] + list(plan['3d']) + plan['invariant']:
+        if var not in variables:
+            errors.append('%s is missing' % var)
+            continue
+        available = variables[var]['levels'] or []
+        missing = [l for l in plan['3d'].get(var) or [] if l * 100 not in available]
+        if missing:
+            errors.append('Levels %s hPa of %s are missing' % (missing, var))
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run (YYYYMMDDHH), defaults to the one exported by copy_data.run or the latest one in the catalog',
+                        required=False, default=get_run_from_env())
+    parser.add_argument('-f', '--folder', help='Folder with the catalog',
+                        required=False, default='.')
+    parser.add_argument('--check', help='Check that the run has all the inputs of the products',
+                        required=False, action='store_true')
+    parser.add_argument('--products', help='Products to check, all of them by default',
+                        required=False, default=None, nargs='+')
+    args = parser.parse_args()
+
+    catalog = load_catalog(args.folder)
+    run = args.run or max(catalog['runs'] or [None])
+
+    if args.check:
+        errors = check_run(catalog, run, args.folder, args.products)
+        for error in errors:
+            print(error)
+        sys.exit(1 if errors else 0)
+
+    for var, entry in sorted(catalog['runs'].get(run, {'variables': {}})['variables'].items()):
+        print('%-22s %-32s %3s levels %3s times' %
+              (var, entry['file'], len(entry['levels'] or []), len(entry['times'] or [])))
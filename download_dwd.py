@@ -0,0 +1,569 @@
+"""Download and decompress the ICON-D2 GRIB files of a run in a single process.
+This replaces the wget | bzip2 pipeline of get_and_extract_one: all the files of
+all the variables share one pool of keep-alive connections, the number of
+concurrent downloads is bounded globally, failed downloads are retried with
+an exponential backoff and the bz2 decompression runs on a separate thread pool
+(bz2 releases the GIL). The merging of the files is still done by cdo in
+functions_download_dwd.sh. Called from copy_data.run as
+
+    python download_dwd.py --vars_2d t_2m pmsl --vars_3d t fi --report download_report.json
+
+or with --products plot_cape.py plot_meteogram.py to download only the variables
+and pressure levels needed by these scripts (see products.py).
+
+Every file that is written is recorded in a per-run manifest together with the
+size and Last-Modified of the remote file, its decompressed size and checksum.
+On a rerun only files which are missing or don't match the manifest are
+downloaded again, and
+
+    python download_dwd.py --check --vars_2d t_2m
+
+exits with an error if any file of the variables is missing or invalid, which
+is used by the merging functions to refuse to run on incomplete inputs.
+"""
+import os
+import re
+import bz2
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from listing_cache import get_session, get_hrefs
+from products import plan_fetch, parse_levels
+
+# Can be pointed to a mirror, e.g. benchmarks/dwd_mirror.py
+base_url = os.getenv('ICON_D2_URL', "https://opendata.dwd.de/weather/nwp/icon-d2/grib")
+
+file_templates = {
+    '2d': "icon-d2_germany_regular-lat-lon_single-level_%s_(.*)_2d_%s.grib2.bz2",
+    '3d': "icon-d2_germany_regular-lat-lon_pressure-level_%s_(.*)_%s.grib2.bz2",
+}
+
+
+def get_run_from_env():
+    """Run in the format YYYYMMDDHH as exported by copy_data.run"""
+    try:
+        return os.environ['year'] + os.environ['month'] + os.environ['day'] + os.environ['run']
+    except KeyError:
+        return None
+
+
+def merged_file(var, run):
+    """Name of the file produced by the merging of var in functions_download_dwd.sh"""
+    return '%s_%s_de.nc' % (var, run)
+
+
+def file_step(name, run):
+    """Forecast step (hours) of a GRIB file of run"""
+    return int(re.search(r'_%s_(\d{3})_' % run, name).group(1))
+
+
+def file_level(name, run):
+    """Pressure level (hPa) of a GRIB file of a 3d variable of run"""
+    return int(re.search(r'_%s_\d{3}_(\d+)_' % run, name).group(1))
+
+
+def manifest_file(run, folder='.'):
+    return os.path.join(folder, 'manifest_%s.jsonl' % run)
+
+
+class Manifest(object):
+    """Record of the files downloaded for a run. Entries are appended as JSON
+    lines as soon as a file is written, so that the manifest survives a job
+    which is killed, and the last entry for every file wins when reading.
+    There are two kinds of entries: the list of files of a variable as seen on
+    the server, and the description of a file written on disk."""
+
+    def __init__(self, run, folder='.'):
+        self.path = manifest_file(run, folder)
+        self.run = run
+        self.folder = folder
+        self.variables = {}
+        self.levels = {}
+        self.files = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a job that was killed while writing
+                        continue
+                    if 'variable' in entry:
+                        self.variables[entry['variable']] = entry['files']
+                        self.levels[entry['variable']] = entry.get('levels')
+                    elif 'file' in entry:
+                        self.files[entry['file']] = entry
+
+    def append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def add_variable(self, var, urls):
+        """Record the files of var and, for 3d variables, the pressure
+        levels (hPa) among them."""
+        files = [os.path.basename(url).replace('.bz2', '') for url in urls]
+        levels = sorted(set(file_level(f, self.run) for f in files
+                            if '_pressure-level_' in f)) or None
+        self.variables[var] = files
+        self.levels[var] = levels
+        self.append({'variable': var, 'files': files, 'levels': levels})
+
+    def add_file(self, entry):
+        self.files[entry['file']] = entry
+        self.append(entry)
+
+    def is_valid(self, name, checksum=True):
+        """A file is valid if it exists and matches size (and checksum)
+        of the manifest."""
+        entry = self.files.get(name)
+        path = os.path.join(self.folder, name)
+        if entry is None or not os.path.isfile(path):
+            return False
+        if os.path.getsize(path) != entry['bytes']:
+            return False
+        if checksum:
+            return file_checksum(path) == entry['sha256']
+        return True
+
+    def check_variable(self, var, checksum=True):
+        """Return the files of var which are missing or invalid. If var
+        was never listed we cannot know which files are expected."""
+        if var not in self.variables or not self.variables[var]:
+            return None
+        return [name for name in self.variables[var]
+                if not self.is_valid(name, checksum)]
+
+
+def file_checksum(path, blocksize=2 ** 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def list_files(var, kind, run, session=None, levels=None):
+    """Urls of the files of var for run currently on the server. For 3d
+    variables only the pressure levels (hPa) in levels are kept, all of
+    them if levels is None."""
+    url = "%s/%s/%s/" % (base_url, run[-2:], var)
+    pattern = re.compile(file_templates[kind] % (run, re.escape(var)))
+    hrefs = [href for href in get_hrefs(url, session=session)
+             if pattern.fullmatch(href)]
+    if kind == '3d' and levels is not None:
+        hrefs = [href for href in hrefs if file_level(href, run) in levels]
+    return [url + href for href in hrefs]
+
+
+def print_message(message):
+    print('%s %s : %s' % (time.strftime('%H:%M:%S'), os.path.basename(sys.argv[0]), message))
+    sys.stdout.flush()
+
+
+class ConcurrencyController(object):
+    """Number of downloads in flight adapted to the server in AIMD style.
+    Every time twice as many downloads as the current limit are completed
+    the throughput of this window is measured (the first window after a
+    change is skipped, as it still contains downloads started before): the
+    limit is increased by one, unless the last increase did not improve the
+    throughput by at least tolerance, in which case it goes back by one.
+    The limit is multiplied by decrease when the server says it is
+    overloaded (429, 503), only once for all the downloads which were in
+    flight at that moment, or when more than error_rate of the downloads
+    of a window failed with other transient errors (5xx, connection errors,
+    truncated responses). The decisions are logged and kept in decisions."""
+
+    def __init__(self, initial=4, minimum=1, maximum=16, decrease=0.5,
+                 tolerance=0.05, error_rate=0.1, verbose=True):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.in_flight = 0
+        self.generation = 0
+        self.condition = threading.Condition()
+        self.start = time.time()
+        self.decisions = []
+        self.last_throughput = None
+        self.reset_window(increased=False, settling=False)
+
+    def reset_window(self, increased, settling=True):
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_done = 0
+        self.window_errors = 0
+        self.increased = increased
+        self.settling = settling
+
+    def acquire(self):
+        """Wait for a free slot, returns the generation to be given to release"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return self.generation
+
+    def release(self, generation, nbytes=0, error=None, overload=False):
+        """Free the slot taken by a download which transferred nbytes or
+        failed with error."""
+        with self.condition:
+            self.in_flight -= 1
+            if overload:
+                if generation == self.generation:
+                    self.multiplicative_decrease(error)
+            else:
+                self.window_done += 1
+                if error is not None:
+                    self.window_errors += 1
+                else:
+                    self.window_bytes += nbytes
+                if self.window_done >= 2 * int(self.limit):
+                    self.end_window()
+            self.condition.notify_all()
+
+    def multiplicative_decrease(self, reason):
+        self.decide(max(self.minimum, int(self.limit * self.decrease)), 'decrease', reason)
+        self.generation += 1
+        self.last_throughput = None
+        self.reset_window(increased=False)
+
+    def end_window(self):
+        if self.settling:
+            return self.reset_window(self.increased, settling=False)
+        if self.window_errors > self.error_rate * self.window_done:
+            return self.multiplicative_decrease('%d errors in %d downloads' %
+                                                (self.window_errors, self.window_done))
+        elapsed = time.time() - self.window_start
+        throughput = self.window_bytes / elapsed if elapsed > 0 else 0.
+        last = self.last_throughput
+        self.last_throughput = throughput
+        reason = '%.1f MB/s' % (throughput / 1e6)
+        if self.increased and last is not None and \
+                throughput < last * (1 + self.tolerance):
+            self.decide(max(self.minimum, self.limit - 1), 'no gain', reason)
+            self.reset_window(increased=False)
+        elif self.limit < self.maximum:
+            self.decide(self.limit + 1, 'increase', reason)
+            self.reset_window(increased=True)
+        else:
+            self.reset_window(increased=False, settling=False)
+
+    def decide(self, limit, action, reason):
+        if limit == self.limit:
+            return
+        self.decisions.append({'time': round(time.time() - self.start, 3),
+                               'limit': int(limit), 'action': action,
+                               'reason': str(reason)})
+        if self.verbose:
+            print_message('%s concurrency %d -> %d (%s)' %
+                          (action, self.limit, limit, reason))
+        self.limit = limit
+
+
+def retry_after(response):
+    """Seconds to wait asked by the server with a Retry-After header"""
+    try:
+        return float(response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return 0.
+
+
+def read_body(response, url, decompress=False):
+    """Read the body of response checking that it is complete. With decompress
+    the bz2 data is decompressed while it is received, so that the compressed
+    file is never held as a whole. Returns the content and the number of bytes
+    received."""
+    expected = response.headers.get('Content-Length')
+    if decompress:
+        decompressor = bz2.BZ2Decompressor()
+        chunks = []
+        received = 0
+        try:
+            for chunk in response.iter_content(chunk_size=2 ** 16):
+                received += len(chunk)
+                chunks.append(decompressor.decompress(chunk))
+        except (OSError, EOFError) as e:
+            raise requests.ConnectionError('%s corrupted: %s' % (url, e))
+        content = b''.join(chunks)
+        complete = decompressor.eof
+    else:
+        content = response.content
+        received = len(content)
+        complete = True
+    if not complete or (expected is not None and int(expected) != received):
+        raise requests.ConnectionError('%s truncated: %d of %s bytes' %
+                                       (url, received, expected))
+    return content, received
+
+
+def download_file(url, session, retries=3, backoff=1., timeout=60, controller=None,
+                  decompress=False):
+    """Download url into memory retrying with exponential backoff on
+    connection errors, server errors and truncated responses. Every attempt
+    takes a slot of the controller, if given, and reports its outcome to it.
+    Returns the content (decompressed if decompress), the Last-Modified header,
+    the number of attempts that were needed and the bytes received."""
+    for attempt in range(1, retries + 1):
+        generation = controller.acquire() if controller is not None else None
+        outcome = {}
+        try:
+            response = session.get(url, timeout=timeout, stream=decompress)
+            response.raise_for_status()
+            content, received = read_body(response, url, decompress)
+            outcome = {'nbytes': received}
+        except requests.RequestException as e:
+            status = getattr(e.response, 'status_code', None)
+            # Client errors (except too many requests) will not go away by retrying
+            transient = status is None or status >= 500 or status == 429
+            outcome = {'error': (status or type(e).__name__) if transient else None,
+                       'overload': status in (429, 503)}
+            if not transient or attempt == retries:
+                raise
+            wait = max(backoff * 2 ** (attempt - 1), retry_after(e.response))
+        except Exception as e:
+            # e.g. an invalid Content-Length, reported as an error like the others
+            outcome = {'error': type(e).__name__}
+            raise
+        else:
+            return content, response.headers.get('Last-Modified'), attempt, received
+        finally:
+            # The slot is released whatever happened, or it would be lost
+            if controller is not None:
+                controller.release(generation, **outcome)
+        time.sleep(wait)
+
+
+def decompress_file(data, target):
+    """Decompress bz2 data into target. We first write to a temporary file
+    so that an interrupted job never leaves a truncated file behind.
+    Returns size and checksum of the decompressed file."""
+    start = time.time()
+    decompressed = bz2.decompress(data)
+    checksum = hashlib.sha256(decompressed).hexdigest()
+    tmp = target + '.part'
+    with open(tmp, 'wb') as f:
+        f.write(decompressed)
+    os.replace(tmp, target)
+    return len(decompressed), checksum, time.time() - start
+
+
+def download_files(urls, folder='.', workers=16, decompress_workers=4,
+                   retries=3, backoff=1., session=None, manifest=None,
+                   checksum=True, controller=None):
+    """Download and decompress all urls into folder. Files which are already
+    valid according to the manifest are skipped, without a manifest we skip
+    the files that exist. At most workers files are downloaded at the same
+    time, less if a ConcurrencyController is given. Returns a list with one
+    record (bytes, timings, status) for every url."""
+    if session is None:
+        session = get_session(pool_size=workers)
+
+    def fetch(url):
+        start = time.time()
+        data, last_modified, attempts, _ = download_file(url, session, retries, backoff,
+                                                         controller=controller)
+        return data, last_modified, attempts, time.time() - start
+
+    records = []
+    with ThreadPoolExecutor(max_workers=workers) as download_pool, \
+            ThreadPoolExecutor(max_workers=decompress_workers) as decompress_pool:
+        downloads = {}
+        for url in urls:
+            name = os.path.basename(url).replace('.bz2', '')
+            if manifest is not None:
+                skip = manifest.is_valid(name, checksum)
+            else:
+                skip = os.path.isfile(os.path.join(folder, name))
+            if skip:
+                records.append({'url': url, 'status': 'skipped'})
+                continue
+            downloads[download_pool.submit(fetch, url)] = (url, name)
+
+        decompressions = {}
+        for future in as_completed(downloads):
+            url, name = downloads[future]
+            try:
+                data, last_modified, attempts, download_time = future.result()
+            except Exception as e:
+                records.append({'url': url, 'status': 'failed', 'error': str(e)})
+                continue
+            record = {'url': url, 'file': name, 'status': 'downloaded',
+                      'attempts': attempts, 'compressed_bytes': len(data),
+                      'last_modified': last_modified, 'download_time': download_time}
+            future = decompress_pool.submit(decompress_file, data,
+                                            os.path.join(folder, name))
+            decompressions[future] = record
+
+        for future in as_completed(decompressions):
+            record = decompressions[future]
+            try:
+                record['bytes'], record['sha256'], record['decompress_time'] = future.result()
+            except Exception as e:
+                record['status'] = 'failed'
+                record['error'] = str(e)
+            else:
+                if manifest is not None:
+                    manifest.add_file({'file': record['file'], 'url': record['url'],
+                                       'remote_bytes': record['compressed_bytes'],
+                                       'last_modified': record['last_modified'],
+                                       'bytes': record['bytes'],
+                                       'sha256': record['sha256']})
+            records.append(record)
+
+    return records
+
+
+def make_report(records, elapsed):
+    """Summary of a download to be saved as JSON."""
+    downloaded = [r for r in records if r['status'] == 'downloaded']
+    compressed_bytes = sum(r['compressed_bytes'] for r in downloaded)
+    return {
+        'files': len(records),
+        'downloaded': len(downloaded),
+        'skipped': sum(r['status'] == 'skipped' for r in records),
+        'failed': sum(r['status'] == 'failed' for r in records),
+        'compressed_bytes': compressed_bytes,
+        'bytes': sum(r['bytes'] for r in downloaded),
+        'elapsed': elapsed,
+        'throughput_mbps': compressed_bytes * 8 / 1e6 / elapsed if elapsed > 0 else None,
+        'records': records,
+    }
+
+
+def download_run(run, vars_2d=[], vars_3d=[], folder='.', workers=16,
+                 decompress_workers=4, retries=3, backoff=1., checksum=True,
+                 levels={}, initial_workers=4, adaptive=True):
+    """Download all the files of the 2d and 3d variables for run. Variables
+    which were already merged are skipped, as in functions_download_dwd.sh,
+    otherwise only the files which are not valid in the manifest are downloaded.
+    levels maps 3d variables to the pressure levels to download, all the
+    levels are downloaded for the variables which are not there. When adaptive
+    the number of concurrent downloads starts from initial_workers and is
+    adapted to the server (see ConcurrencyController) up to workers."""
+    start = time.time()
+    session = get_session(pool_size=workers)
+    manifest = Manifest(run, folder)
+    variables = [(var, '2d') for var in vars_2d] + [(var, '3d') for var in vars_3d]
+    variables = [(var, kind) for var, kind in variables
+                 if not os.path.isfile(os.path.join(folder, merged_file(var, run)))]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = list(executor.map(lambda v: list_files(v[0], v[1], run, session,
+                                                          levels.get(v[0])),
+                                     variables))
+    for (var, _), listing in zip(variables, listings):
+        manifest.add_variable(var, listing)
+    urls = [url for listing in listings for url in listing]
+
+    controller = None
+    if adaptive:
+        controller = ConcurrencyController(initial=initial_workers, maximum=workers)
+    records = download_files(urls, folder, workers, decompress_workers,
+                             retries, backoff, session, manifest, checksum,
+                             controller)
+
+    report = make_report(records, time.time() - start)
+    if controller is not None:
+        report['concurrency'] = controller.decisions
+        report['final_workers'] = int(controller.limit)
+    # A variable which is not on the server would otherwise be silently missing from the plots
+    report['missing_variables'] = [var for (var, _), listing in zip(variables, listings)
+                                   if not listing]
+    return report
+
+
+def check_run(run, variables, folder='.', checksum=True):
+    """Return a dictionary with the missing or invalid files of every variable
+    which is not complete (None if the variable was never listed)."""
+    manifest = Manifest(run, folder)
+    incomplete = {}
+    for var in variables:
+        invalid = manifest.check_variable(var, checksum)
+        if invalid is None or invalid:
+            incomplete[var] = invalid
+    return incomplete
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run to download (YYYYMMDDHH), defaults to the one exported by copy_data.run',
+                        required=False, default=get_run_from_env())
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be downloaded',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be downloaded',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('--products', help='Download the variables and levels needed by these plotting scripts (see products.py)',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('--levels', help='Pressure levels (hPa) of 3d variables, e.g. t=500,850 fi=all, overriding the products',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-f', '--folder', help='Folder where the files are saved',
+                        required=False, default='.')
+    parser.add_argument('-w', '--workers', help='Maximum number of concurrent downloads',
+                        required=False, default=16, type=int)
+    parser.add_argument('--initial_workers', help='Number of concurrent downloads to start with, then adapted to the server',
+                        required=False, default=4, type=int)
+    parser.add_argument('--fixed', help='Always download --workers files at the same time',
+                        required=False, action='store_true')
+    parser.add_argument('-d', '--decompress_workers', help='Number of threads used to decompress',
+                        required=False, default=4, type=int)
+    parser.add_argument('--retries', help='Number of attempts for every file',
+                        required=False, default=3, type=int)
+    parser.add_argument('--backoff', help='Seconds to wait before the first retry, doubled at every attempt',
+                        required=False, default=1., type=float)
+    parser.add_argument('--report', help='Save a JSON report of bytes and timings to this file',
+                        required=False, default=None)
+    parser.add_argument('--check', help='Only check that all the files of the variables are valid',
+                        required=False, action='store_true')
+    parser.add_argument('--no_checksum', help='Verify existing files only by their size',
+                        required=False, action='store_true')
+    args = parser.parse_args()
+
+    if args.run is None:
+        parser.error('run not given and not found in the environment')
+
+    levels = {}
+    if args.products:
+        plan = plan_fetch(args.products)
+        # Variables given explicitly with --vars_3d are downloaded on all the levels
+        levels = dict((var, l) for var, l in plan['3d'].items()
+                      if l is not None and var not in args.vars_3d)
+        args.vars_2d += [var for var in plan['2d'] if var not in args.vars_2d]
+        args.vars_3d += [var for var in plan['3d'] if var not in args.vars_3d]
+    try:
+        levels.update(parse_levels(args.levels))
+    except ValueError as e:
+        parser.error(str(e))
+    args.vars_3d += [var for var in levels if var not in args.vars_3d]
+
+    if args.check:
+        incomplete = check_run(args.run, args.vars_2d + args.vars_3d, args.folder,
+                               checksum=not args.no_checksum)
+        for var, invalid in incomplete.items():
+            if invalid is None:
+                print('%s: no files listed in the manifest' % var)
+            else:
+                print('%s: %d missing or invalid files, e.g. %s' % (var, len(invalid), invalid[0]))
+        sys.exit(1 if incomplete else 0)
+
+    report = download_run(args.run, args.vars_2d, args.vars_3d, args.folder,
+                          args.workers, args.decompress_workers, args.retries,
+                          args.backoff, checksum=not args.no_checksum, levels=levels,
+                          initial_workers=args.initial_workers, adaptive=not args.fixed)
+    print('Downloaded %d files (%d skipped, %d failed), %.1f MB in %.1f s' %
+          (report['downloaded'], report['skipped'], report['failed'],
+           report['compressed_bytes'] / 1e6, report['elapsed']))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+    if report['missing_variables']:
+        print('No files on the server for %s' % ' '.join(report['missing_variables']))
+    if report['failed'] > 0 or report['missing_variables']:
+        sys.exit(1)
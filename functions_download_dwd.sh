@@ -1,58 +1,65 @@
 #Given a variable name and year-month-day-run as environmental variables download and merges the variable
 ################################################
+# The listing is cached on disk and only downloaded again if it changed on the server
 listurls() {
 	filename="$1"
 	url="$2"
-	wget -qO- $url | grep -Eoi '<a [^>]+>' | \
-	grep -Eo 'href="[^\"]+"' | \
-	grep -Eo $filename | \
-	xargs -I {} echo "$url"{}
+	python ${HOME_FOLDER}/listing_cache.py "$url" "$filename"
 }
 export -f listurls
-#
-get_and_extract_one() {
-  url="$1"
-  file=`basename $url | sed 's/\.bz2//g'`
-  if [ ! -f "$file" ]; then
-  	wget -t 2 -q -O - "$url" | bzip2 -dc > "$file"
-  fi
-}
-export -f get_and_extract_one
 ##############################################
-download_merge_2d_variable_icon_d2()
+# Merge the files of a variable which were already downloaded, e.g. by download_dwd.py
+merge_2d_variable_icon_d2()
 {
 	filename="icon-d2_germany_regular-lat-lon_single-level_${year}${month}${day}${run}_*_2d_${1}.grib2"
-	filename_grep="icon-d2_germany_regular-lat-lon_single-level_${year}${month}${day}${run}_(.*)_2d_${1}.grib2.bz2"
-	url="https://opendata.dwd.de/weather/nwp/icon-d2/grib/${run}/${1}/"
 	if [ ! -f "${1}_${year}${month}${day}${run}_de.nc" ]; then
-		listurls $filename_grep $url | parallel -j 10 get_and_extract_one {}
+		# Refuse to merge if some files are missing or don't match the download manifest
+		python ${HOME_FOLDER}/download_dwd.py --check --vars_2d ${1} || \
+			{ echo "Files of ${1} are incomplete, not merging"; return 1; }
 		cdo -f nc copy -mergetime ${filename} ${1}_${year}${month}${day}${run}_de.nc
 		rm ${filename}
 	fi
 }
-export -f download_merge_2d_variable_icon_d2
+export -f merge_2d_variable_icon_d2
 ##############################################
-download_merge_3d_variable_icon_d2()
+merge_3d_variable_icon_d2()
 {
 	filename="icon-d2_germany_regular-lat-lon_pressure-level_${year}${month}${day}${run}_*_${1}.grib2"
-	filename_grep="icon-d2_germany_regular-lat-lon_pressure-level_${year}${month}${day}${run}_(.*)_${1}.grib2.bz2"
-	url="https://opendata.dwd.de/weather/nwp/icon-d2/grib/${run}/${1}/"
 	if [ ! -f "${1}_${year}${month}${day}${run}_de.nc" ]; then
-		listurls $filename_grep $url | parallel -j 10 get_and_extract_one {}
+		# Refuse to merge if some files are missing or don't match the download manifest
+		python ${HOME_FOLDER}/download_dwd.py --check --vars_3d ${1} || \
+			{ echo "Files of ${1} are incomplete, not merging"; return 1; }
 		cdo merge ${filename} ${1}_${year}${month}${day}${run}_de.grib2
 		rm ${filename}
 		cdo -f nc copy ${1}_${year}${month}${day}${run}_de.grib2 ${1}_${year}${month}${day}${run}_de.nc
 		rm ${1}_${year}${month}${day}${run}_de.grib2
 	fi
 }
+export -f merge_3d_variable_icon_d2
+##############################################
+download_merge_2d_variable_icon_d2()
+{
+	if [ ! -f "${1}_${year}${month}${day}${run}_de.nc" ]; then
+		python ${HOME_FOLDER}/download_dwd.py --vars_2d ${1} --workers 10
+		merge_2d_variable_icon_d2 ${1}
+	fi
+}
+export -f download_merge_2d_variable_icon_d2
+##############################################
+download_merge_3d_variable_icon_d2()
+{
+	if [ ! -f "${1}_${year}${month}${day}${run}_de.nc" ]; then
+		python ${HOME_FOLDER}/download_dwd.py --vars_3d ${1} --workers 10
+		merge_3d_variable_icon_d2 ${1}
+	fi
+}
 export -f download_merge_3d_variable_icon_d2
 ################################################
+# The GRIB file is converted (and cropped as the other variables) by ingest.py --invariants hsurf
 download_invariant_icon_d2()
 {
 	filename="icon-d2_germany_regular-lat-lon_time-invariant_${year}${month}${day}${run}_000_0_hsurf.grib2"
-	wget -r -nH -np -nv -nd --reject "index.html*" --cut-dirs=3 -A "${filename}.bz2" "https://opendata.dwd.de/weather/nwp/icon-d2/grib/${run}/hsurf/"
+	wget -r -nH -np -nv -nd --reject "index.html*" --cut-dirs=3 -A "${filename}.bz2" "${ICON_D2_URL:-https://opendata.dwd.de/weather/nwp/icon-d2/grib}/${run}/hsurf/"
 	bzip2 -d ${filename}.bz2 
-	cdo -f nc copy ${filename} HSURF_${year}${month}${day}${run}_de.nc
-	rm ${filename}
 }
 export -f download_invariant_icon_d2
@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
-import requests
-from bs4 import BeautifulSoup
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import argparse
+from listing_cache import get_session, get_url_paths
 
 
 parser = argparse.ArgumentParser()
@@ -14,8 +15,14 @@ parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be checke
                     required=False, default=['t'], nargs='+')
 parser.add_argument('-l', '--levels_3d', help='List of 3d levels to be checked',
                     required=False, default=['850'], nargs='+')
-
-args = parser.parse_args()
+parser.add_argument('-w', '--workers', help='Number of listings to download concurrently',
+                    required=False, default=8, type=int)
+parser.add_argument('-s', '--search', help='Check all the runs (all) or stop at the newest complete run (newest)',
+                    required=False, default='newest', choices=['all', 'newest'])
+parser.add_argument('--started', help='Return the most recent run with at least one file for every variable',
+                    required=False, action='store_true')
+parser.add_argument('-t', '--table', help='Print the table with the status of the runs checked on stderr',
+                    required=False, action='store_true')
 
 var_2d_list = ['alb_rad', 'alhfl_s', 'ashfl_s', 'asob_s', 'asob_t', 'aswdifd_s', 'aswdifu_s',
                'aswdir_s', 'athb_s', 'cape_ml', 'cin_ml', 'clch', 'clcl', 'clcm', 'clct',
@@ -29,16 +36,51 @@ var_3d_list = ['clc', 'fi', 'omega', 'p',
                'qv', 'relhum', 't', 'tke', 'u', 'v', 'w']
 
 
-def get_url_paths(url, ext='', prefix='', params={}):
-    response = requests.get(url, params=params)
-    if response.ok:
-        response_text = response.text
-    else:
-        return response.raise_for_status()
-    soup = BeautifulSoup(response_text, 'html.parser')
-    parent = [url + node.get('href') for node in soup.find_all('a') if (
-        node.get('href').endswith(ext)) & (node.get('href').startswith(prefix))]
-    return parent
+def get_listing(url, ext='', prefix='', listings=None, session=None):
+    """Return the files in the listing at url, filtered by ext and prefix.
+    If listings is given it is used as a cache: every listing is downloaded
+    and parsed only the first time that it is needed."""
+    if listings is None:
+        return get_url_paths(url, ext, prefix=prefix, session=session)
+    if url not in listings:
+        try:
+            listings[url] = get_url_paths(url, session=session)
+        except Exception as e:
+            listings[url] = e
+    files = listings[url]
+    # A failed download is stored with its exception so that the caller
+    # sees the same error it would see without the cache
+    if isinstance(files, Exception):
+        raise files
+    return [f for f in files if f.endswith(ext) and f.startswith(url + prefix)]
+
+
+def fetch_listings(urls, ext='', session=None, workers=8):
+    """Download and parse concurrently all the listings in urls, sharing
+    the connections of one session. Every listing is parsed only once,
+    the result maps every url to its files (or to the exception raised)."""
+    if session is None:
+        session = get_session(pool_size=workers)
+
+    def fetch(url):
+        try:
+            return get_url_paths(url, ext, session=session)
+        except Exception as e:
+            return e
+
+    urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = dict(zip(urls, executor.map(fetch, urls)))
+
+    return listings
+
+
+def listing_url(var, run_string,
+                base_url="https://opendata.dwd.de/weather/nwp",
+                model_url="icon-d2-eps/grib"):
+    """Url of the directory listing of a variable for a given run.
+    Note that this does not depend on the date."""
+    return "%s/%s/%s/%s/" % (base_url, model_url, run_string, var)
 
 
 def find_file_name(vars_2d=None,
@@ -47,7 +89,9 @@ def find_file_name(vars_2d=None,
                    base_url="https://opendata.dwd.de/weather/nwp",
                    model_url="icon-d2-eps/grib",
                    date_string=None,
-                   run_string=None):
+                   run_string=None,
+                   listings=None,
+                   session=None):
     if run_string == '03':
         f_times = list(range(0, 46))
     else:
@@ -87,8 +131,9 @@ def find_file_name(vars_2d=None,
                 urls_to_check.append("%s/%s/%s/%s/%s_%s%s_%03d_2d_%s.grib2.bz2" %
                                      (base_url, model_url, run_string, var,
                                       var_url, date_string, run_string, f_time, var))
-            urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
+            urls_on_server = get_listing(listing_url(var, run_string, base_url, model_url),
+                                         'grib2.bz2', prefix=var_url,
+                                         listings=listings, session=session)
             if set(urls_to_check).issubset(urls_on_server):
                 data['status'].append('all files available')
                 data['avail_tsteps'].append(len(urls_to_check))
@@ -113,8 +158,9 @@ def find_file_name(vars_2d=None,
                     urls_to_check.append("%s/%s/%s/%s/%s_%s%s_%03d_%s_%s.grib2.bz2" %
                                          (base_url, model_url, run_string, var,
                                           var_url, date_string, run_string, f_time, plev, var))
-            urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
+            urls_on_server = get_listing(listing_url(var, run_string, base_url, model_url),
+                                         'grib2.bz2', prefix=var_url,
+                                         listings=listings, session=session)
             if set(urls_to_check).issubset(urls_on_server):
                 data['status'].append('all files available')
                 data['avail_tsteps'].append(len(urls_to_check))
@@ -132,32 +178,85 @@ def find_file_name(vars_2d=None,
 
 
 def get_most_recent_run(run=None, vars_2d=None, vars_3d=['t'],
-                        levels_3d=['850']):
-    today_string = datetime.now().strftime('%Y%m%d')
-    yesterday_string = (datetime.today() -
-                        timedelta(days=1)).strftime('%Y%m%d')
+                        levels_3d=['850'], workers=8, search='all', started=False,
+                        base_url="https://opendata.dwd.de/weather/nwp",
+                        model_url="icon-d2-eps/grib"):
+    """Check the runs of yesterday and today and return the table with their
+    status together with the most recent complete run.
+    With search='all' all the runs are checked, downloading all the listings
+    concurrently. With search='newest' the runs are checked from the newest
+    to the oldest and we stop at the first one which is complete, so that
+    the table only contains the runs that were checked.
+    With started=True a run is selected as soon as some files of every
+    variable are available, which is used to process runs progressively."""
+    # The runs are named in UTC, the dates must be too
+    now = datetime.utcnow()
+    today_string = now.strftime('%Y%m%d')
+    yesterday_string = (now - timedelta(days=1)).strftime('%Y%m%d')
     if run is None:
         runs = ['00', '03', '06', '09', '12', '15', '18', '21']
     else:
         runs = [run]
+    if search not in ['all', 'newest']:
+        raise ValueError('search should be one of all, newest')
+
+    session = get_session(pool_size=workers)
+    if search == 'all':
+        # The listings only depend on run and variable, so we download all of them
+        # concurrently once and then reuse them for both dates
+        variables = (vars_2d or []) + (vars_3d or [])
+        listings = fetch_listings([listing_url(var, run_string, base_url, model_url)
+                                   for run_string in runs for var in variables],
+                                  ext='grib2.bz2', session=session, workers=workers)
+        candidates = [(date_string, run_string)
+                      for date_string in [yesterday_string, today_string]
+                      for run_string in runs]
+    else:
+        # Listings are downloaded lazily and cached, runs which have not
+        # started yet cannot be on the server so we don't check them
+        listings = {}
+        candidates = [(date_string, run_string)
+                      for date_string in [today_string, yesterday_string]
+                      for run_string in sorted(runs, reverse=True)
+                      if date_string + run_string <= now.strftime('%Y%m%d%H')]
+
     temp = []
-    for date_string in [yesterday_string, today_string]:
-        for run_string in runs:
-            try:
-                temp.append(find_file_name(vars_2d=vars_2d,
-                                           vars_3d=vars_3d,
-                                           levels_3d=levels_3d,
-                                           date_string=date_string,
-                                           run_string=run_string))
-            except:
-                continue
+    for date_string, run_string in candidates:
+        try:
+            df = find_file_name(vars_2d=vars_2d,
+                                vars_3d=vars_3d,
+                                levels_3d=levels_3d,
+                                base_url=base_url,
+                                model_url=model_url,
+                                date_string=date_string,
+                                run_string=run_string,
+                                listings=listings,
+                                session=session)
+        except:
+            continue
+        temp.append(df)
+        if started:
+            selected = df.avail_tsteps > 0
+        else:
+            selected = df.status == 'all files available'
+        if search == 'newest' and selected.all():
+            break
 
     final = pd.concat(temp)
-    sel_run = final.loc[final.status == 'all files available', 'run'].max()
+    if started:
+        sel_run = final.loc[final.avail_tsteps > 0, 'run'].max()
+    else:
+        sel_run = final.loc[final.status == 'all files available', 'run'].max()
     return final, sel_run
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     final, sel_run = get_most_recent_run(run=args.run, vars_2d=args.vars_2d,
-                        vars_3d=args.vars_3d, levels_3d=args.levels_3d)
+                        vars_3d=args.vars_3d, levels_3d=args.levels_3d,
+                        workers=args.workers, search=args.search,
+                        started=args.started)
+    if args.table:
+        # stdout is used by copy_data.run to read the run
+        print(final.to_string(index=False), file=sys.stderr)
     print(sel_run)
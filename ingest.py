@@ -0,0 +1,645 @@
+"""Decode the GRIB files of a run with ecCodes and write the per-variable NetCDF
+files read by read_dataset in plotting/utils.py, replacing the cdo merge/copy
+steps of functions_download_dwd.sh. Every GRIB message is decoded in memory and
+written directly at its place in the (time, [plev,] lat, lon) variable of the
+output file, so no merged GRIB or intermediate NetCDF file is ever written.
+The output mimics what cdo produces (variable names, Pa pressure levels,
+ascending latitudes) so that the plotting scripts don't need to change.
+The fields are cropped to the smallest box containing all the projections of
+plotting/projections.py and the cities of the meteograms (plus a margin), so
+that every later reader only deals with the area that is actually plotted.
+Called from copy_data.run as
+
+    python ingest.py --products plot_cape.py plot_meteogram.py --cities Hamburg Pisa
+
+or with explicit lists of variables (--vars_2d t_2m pmsl --vars_3d t fi).
+With --stream the files are not downloaded by download_dwd.py before: they
+are downloaded by this script and go straight from the HTTP stream through
+the bz2 decompressor to the GRIB decoder, so that only the merged files are
+written on disk.
+The variables with output more often than every hour (e.g. 15 minutes) are
+also written with only their full hours in hourly_<var>_<run>_de.nc, which
+read_dataset(freq='1H') reads instead of resampling the data.
+With --pack the variables of packed_ranges are stored as int16 with a
+scale_factor and add_offset (and compressed with --format NETCDF4), which
+halves their size; they are decoded by xarray when read_dataset opens them.
+"""
+import os
+import sys
+import csv
+import argparse
+import threading
+from glob import glob
+from datetime import datetime
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import eccodes
+import netCDF4
+from download_dwd import Manifest, ConcurrencyController, check_run, download_file, \
+    file_step, get_run_from_env, list_files, merged_file
+from catalog import register_file
+from listing_cache import get_session
+from products import plan_fetch, parse_levels
+
+home_folder = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(home_folder, 'plotting'))
+from projections import proj_defs
+
+# Name given by cdo to the variables, when it's not the uppercase DWD name
+variable_names = {
+    't_2m': '2t',
+    'td_2m': '2d',
+    'u_10m': '10u',
+    'v_10m': '10v',
+    'relhum_2m': '2r',
+    'pmsl': 'prmsl',
+    'tot_prec': 'tp',
+    'h_snow': 'sde',
+    't': 't',
+    'fi': 'z',
+    'relhum': 'r',
+    'u': 'u',
+    'v': 'v',
+    'qv': 'q',
+    'clc': 'ccl',
+}
+
+epoch = datetime(1970, 1, 1)
+
+
+def output_name(var):
+    return variable_names.get(var, var.upper())
+
+
+def get_city_coordinates(city):
+    """Coordinates of a city from the cache written by get_city_coordinates
+    in plotting/utils.py, None if the city was never plotted."""
+    cities_file = os.path.join(home_folder, 'plotting', 'cities_coordinates.csv')
+    if os.path.isfile(cities_file):
+        with open(cities_file) as f:
+            for row in csv.reader(f):
+                if row and row[0] == city:
+                    return float(row[1]), float(row[2])
+    return None
+
+
+def get_crop_bbox(projections=None, points=[], margin=1.):
+    """Smallest (lon_min, lat_min, lon_max, lat_max) box containing the extents
+    of projections (all of them by default) and the (lon, lat) points,
+    enlarged by margin degrees on every side."""
+    if projections is None:
+        projections = list(proj_defs)
+    lons = [lon for lon, _ in points]
+    lats = [lat for _, lat in points]
+    for projection in projections:
+        lons += [proj_defs[projection]['llcrnrlon'], proj_defs[projection]['urcrnrlon']]
+        lats += [proj_defs[projection]['llcrnrlat'], proj_defs[projection]['urcrnrlat']]
+    return (min(lons) - margin, min(lats) - margin,
+            max(lons) + margin, max(lats) + margin)
+
+
+def crop_message(message, bbox):
+    """Crop values and coordinates of a decoded message to bbox"""
+    lon_min, lat_min, lon_max, lat_max = bbox
+    ilat = np.where((message['lat'] >= lat_min) & (message['lat'] <= lat_max))[0]
+    ilon = np.where((message['lon'] >= lon_min) & (message['lon'] <= lon_max))[0]
+    lat_slice = slice(ilat[0], ilat[-1] + 1)
+    lon_slice = slice(ilon[0], ilon[-1] + 1)
+    return dict(message, lat=message['lat'][lat_slice], lon=message['lon'][lon_slice],
+                values=message['values'][lat_slice, lon_slice])
+
+
+def decode_message(gid):
+    """Decode a GRIB message on a regular lat-lon grid into a dictionary with
+    values (lat, lon), coordinates, valid time, pressure level (Pa, None for
+    single-level fields) and metadata."""
+    ni = eccodes.codes_get(gid, 'Ni')
+    nj = eccodes.codes_get(gid, 'Nj')
+    values = eccodes.codes_get_values(gid).astype(np.float32).reshape(nj, ni)
+    if eccodes.codes_get(gid, 'bitmapPresent'):
+        values[values == eccodes.codes_get(gid, 'missingValue')] = np.nan
+    lat = np.linspace(eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees'),
+                      eccodes.codes_get(gid, 'latitudeOfLastGridPointInDegrees'), nj)
+    # The longitudes are in 0..360 (the first one is 356.06 on ICON-D2), the
+    # axis goes from the first point by the increment across Greenwich
+    first_lon = eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees')
+    if first_lon > 180:
+        first_lon -= 360
+    lon_step = eccodes.codes_get(gid, 'iDirectionIncrementInDegrees')
+    if eccodes.codes_get(gid, 'iScansNegatively'):
+        lon_step = -lon_step
+    lon = np.round(first_lon + np.arange(ni) * lon_step, 6)
+    # cdo always writes latitudes and longitudes in ascending order
+    if lat[0] > lat[-1]:
+        lat, values = lat[::-1], values[::-1, :]
+    if lon[0] > lon[-1]:
+        lon, values = lon[::-1], values[:, ::-1]
+    time = datetime.strptime('%08d%04d' % (eccodes.codes_get(gid, 'validityDate'),
+                                           eccodes.codes_get(gid, 'validityTime')),
+                             '%Y%m%d%H%M')
+    type_of_level = eccodes.codes_get(gid, 'typeOfLevel')
+    if type_of_level == 'isobaricInhPa':
+        level = eccodes.codes_get(gid, 'level') * 100
+    elif type_of_level == 'isobaricInPa':
+        level = eccodes.codes_get(gid, 'level')
+    else:
+        level = None
+
+    return {'values': values, 'lat': lat, 'lon': lon, 'time': time, 'level': level,
+            'units': eccodes.codes_get(gid, 'units'),
+            'long_name': eccodes.codes_get(gid, 'name')}
+
+
+def iter_messages(path):
+    """Yield the decoded messages of a GRIB file"""
+    with open(path, 'rb') as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                yield decode_message(gid)
+            finally:
+                eccodes.codes_release(gid)
+
+
+def split_messages(data):
+    """Split the content of a GRIB file into its messages, using the total
+    length written in the indicator section of every message."""
+    messages = []
+    offset = 0
+    while offset < len(data):
+        if data[offset:offset + 4] != b'GRIB' or len(data) < offset + 8:
+            raise ValueError('Invalid GRIB data at byte %d' % offset)
+        if data[offset + 7] == 2:
+            if len(data) < offset + 16:
+                raise ValueError('Truncated GRIB message at byte %d' % offset)
+            length = int.from_bytes(data[offset + 8:offset + 16], 'big')
+        else:
+            length = int.from_bytes(data[offset + 4:offset + 7], 'big')
+        if length <= 0 or offset + length > len(data):
+            raise ValueError('Invalid length %d of the GRIB message at byte %d' % (length, offset))
+        messages.append(data[offset:offset + length])
+        offset += length
+    return messages
+
+
+def decode_bytes(data):
+    """Decode the messages of a GRIB file held in memory"""
+    decoded = []
+    for message in split_messages(data):
+        gid = eccodes.codes_new_from_message(message)
+        try:
+            decoded.append(decode_message(gid))
+        finally:
+            eccodes.codes_release(gid)
+    return decoded
+
+
+def create_output(path, name, first, levels, fmt, packing=None):
+    """Create the NetCDF file with the coordinates of the first message. If
+    packing is given the variable is stored as int16 with this scale_factor
+    and add_offset, and the values written must be packed (pack_values)."""
+    nc = netCDF4.Dataset(path, 'w', format=fmt)
+    nc.createDimension('time', None)
+    nc.createDimension('lat', len(first['lat']))
+    nc.createDimension('lon', len(first['lon']))
+    time = nc.createVariable('time', 'f8', ('time',))
+    time.setncatts({'standard_name': 'time', 'axis': 'T', 'calendar': 'proleptic_gregorian',
+                    'units': 'seconds since 1970-01-01 00:00:00'})
+    lat = nc.createVariable('lat', 'f8', ('lat',))
+    lat.setncatts({'standard_name': 'latitude', 'long_name': 'latitude',
+                   'units': 'degrees_north', 'axis': 'Y'})
+    lat[:] = first['lat']
+    lon = nc.createVariable('lon', 'f8', ('lon',))
+    lon.setncatts({'standard_name': 'longitude', 'long_name': 'longitude',
+                   'units': 'degrees_east', 'axis': 'X'})
+    lon[:] = first['lon']
+    dims = ('time', 'lat', 'lon')
+    if levels:
+        nc.createDimension('plev', len(levels))
+        plev = nc.createVariable('plev', 'f8', ('plev',))
+        plev.setncatts({'standard_name': 'air_pressure', 'long_name': 'pressure',
+                        'units': 'Pa', 'positive': 'down', 'axis': 'Z'})
+        plev[:] = levels
+        dims = ('time', 'plev', 'lat', 'lon')
+    if packing is None:
+        var = nc.createVariable(name, 'f4', dims, fill_value=np.float32(np.nan))
+    else:
+        chunks = (1, 1, len(first['lat']), len(first['lon'])) if levels else \
+            (1, len(first['lat']), len(first['lon']))
+        # The compression is ignored by NETCDF3
+        var = nc.createVariable(name, 'i2', dims, fill_value=packed_fill, zlib=True, complevel=1,
+                                shuffle=True, chunksizes=chunks)
+        var.set_auto_maskandscale(False)
+        var.setncatts({'scale_factor': packing[0], 'add_offset': packing[1],
+                       'packing_error': packing[0] / 2})
+    var.setncatts({'long_name': first['long_name'], 'units': first['units']})
+    return nc
+
+
+def hourly_file(var, run):
+    """Name of the file with the hourly view of a variable with sub-hourly output"""
+    return 'hourly_' + merged_file(var, run)
+
+
+# Range of the values of the variables stored as int16 with --pack, the
+# values x are stored as round((x - add_offset) / scale_factor) with
+# scale_factor = (max - min) / 65534 and add_offset = (max + min) / 2, so the
+# error is at most scale_factor / 2, e.g. 0.0012 K for the temperatures,
+# 0.19 Pa for pmsl and 0.0008 % for the cloud covers. Values out of the range
+# are clipped. The accumulated variables (precipitation) are not packed as
+# the rates computed by differences would amplify the error, nor are
+# the codes (ww) which are compared with integers.
+packed_ranges = {
+    't_2m': (180., 340.),
+    'td_2m': (180., 340.),
+    'tmax_2m': (180., 340.),
+    'tmin_2m': (180., 340.),
+    't': (160., 330.),
+    'pmsl': (85000., 110000.),
+    'clct': (0., 100.),
+    'clcl': (0., 100.),
+    'clcm': (0., 100.),
+    'clch': (0., 100.),
+    'relhum': (0., 100.),
+    'relhum_2m': (0., 100.),
+    'u': (-150., 150.),
+    'v': (-150., 150.),
+    'u_10m': (-150., 150.),
+    'v_10m': (-150., 150.),
+    'vmax_10m': (0., 150.),
+    'fi': (-10000., 130000.),
+    'cape_ml': (0., 10000.),
+    'cin_ml': (-2000., 2000.),
+    'h_snow': (0., 20.),
+    'snowlmt': (-1000., 10000.),
+    'dbz_cmax': (-50., 100.),
+    'synmsg_bt_cl_ir10.8': (150., 350.),
+    'hsurf': (-500., 5000.),
+}
+# Value of the missing values of the packed variables
+packed_fill = np.int16(-32768)
+
+
+def packing(var):
+    """scale_factor and add_offset of var stored as int16, None if it is not
+    packed"""
+    if var.lower() not in packed_ranges:
+        return None
+    vmin, vmax = packed_ranges[var.lower()]
+    return np.float32((vmax - vmin) / 65534.), np.float32((vmax + vmin) / 2.)
+
+
+def pack_values(values, packing):
+    """Values stored in the int16 variable with packing, and the number of
+    values out of its range which were clipped"""
+    scale_factor, add_offset = packing
+    packed = np.round((values - add_offset) / scale_factor)
+    clipped = np.count_nonzero(np.abs(packed) > 32767)
+    packed = np.clip(packed, -32767, 32767)
+    return np.where(np.isnan(packed), packed_fill, packed).astype(np.int16), clipped
+
+
+
+# netCDF-C and HDF5 are not thread-safe: the netCDF calls of all the writers
+# of a process (e.g. the variables streamed by threads with --stream) are done
+# one at a time, the downloads and the decoding stay concurrent
+netcdf_lock = threading.Lock()
+
+
+class OutputWriter(object):
+    """Write the decoded messages of a variable, one step after the other,
+    into the merged file read by read_dataset. The output is written to a
+    temporary file which is renamed by close, so readers never see a
+    partial file, and then registered in the catalog of the run. As soon as
+    a time which is not on the hour is written, the frames on the hour are
+    also written to the hourly view. With pack the variables of
+    packed_ranges are stored as int16. With live the output is written in
+    place and every sync publishes the steps written so far, so that they
+    are read while the next ones are written (watch_run.py): the records of
+    a NETCDF3 file are never rewritten, only appended."""
+
+    def __init__(self, var, run, folder='.', fmt='NETCDF3_64BIT_OFFSET', bbox=None, pack=False,
+                 live=False):
+        if live and not fmt.startswith('NETCDF3'):
+            raise ValueError('%s files cannot be read while they are written' % fmt)
+        self.var = var
+        self.run = run
+        self.name = output_name(var)
+        self.target = os.path.join(folder, merged_file(var, run))
+        self.live = live
+        self.tmp = self.target if live else self.target + '.tmp'
+        self.fmt = fmt
+        self.bbox = bbox
+        self.packing = packing(var) if pack else None
+        # Values out of the range of the packing, reported by close
+        self.clipped = 0
+        self.nc = None
+        self.levels = None
+        self.itime = 0
+        self.hourly_target = os.path.join(folder, hourly_file(var, run))
+        self.hourly_tmp = self.hourly_target if live else self.hourly_target + '.tmp'
+        self.hourly = None
+        self.ihourly = 0
+
+    def write_step(self, messages):
+        """Write the messages of a step (all its levels). A file can contain
+        more than one time (e.g. 15 minutes output)."""
+        fields = {}
+        for message in messages:
+            if self.bbox is not None:
+                message = crop_message(message, self.bbox)
+            fields.setdefault(message['time'], []).append(message)
+        with netcdf_lock:
+            self.write_fields(fields)
+
+    def write_fields(self, fields):
+        for time in sorted(fields):
+            messages = fields[time]
+            if self.nc is None:
+                if messages[0]['level'] is not None:
+                    # Pressure levels from the surface upwards as cdo does
+                    self.levels = sorted(set(m['level'] for m in messages), reverse=True)
+                self.nc = create_output(self.tmp, self.name, messages[0], self.levels, self.fmt,
+                                        self.packing)
+            self.nc['time'][self.itime] = (time - epoch).total_seconds()
+            if self.levels:
+                for message in messages:
+                    self.nc[self.name][self.itime, self.levels.index(message['level']), :, :] = \
+                        self.values(message)
+            else:
+                self.nc[self.name][self.itime, :, :] = self.values(messages[0])
+            if self.hourly is None and (time - epoch).total_seconds() % 3600:
+                self.hourly = create_output(self.hourly_tmp, self.name, messages[0],
+                                            self.levels, self.fmt, self.packing)
+                for itime in range(self.itime):
+                    self.write_hourly(itime)
+            if self.hourly is not None:
+                self.write_hourly(self.itime)
+            self.itime += 1
+
+    def values(self, message):
+        if self.packing is None:
+            return message['values']
+        values, clipped = pack_values(message['values'], self.packing)
+        self.clipped += clipped
+        return values
+
+    def write_hourly(self, itime):
+        """Copy the frame itime to the hourly view if it is on the hour"""
+        seconds = self.nc['time'][itime]
+        if seconds % 3600 == 0:
+            self.hourly['time'][self.ihourly] = seconds
+            self.hourly[self.name][self.ihourly] = self.nc[self.name][itime]
+            self.ihourly += 1
+
+    def sync(self):
+        """Publish the steps written so far of a live output"""
+        if self.nc is None:
+            return
+        with netcdf_lock:
+            self.nc.sync()
+            if self.hourly is not None:
+                self.hourly.sync()
+            register_file(self.target, self.var, self.run,
+                          self.hourly_target if self.hourly is not None else None)
+
+    def close(self):
+        if self.nc is None:
+            raise ValueError('No GRIB messages found for %s' % self.var)
+        with netcdf_lock:
+            self.nc.close()
+            if self.hourly is not None:
+                self.hourly.close()
+        os.replace(self.tmp, self.target)
+        if self.hourly is not None:
+            os.replace(self.hourly_tmp, self.hourly_target)
+        # The catalog entries are read from the files
+        with netcdf_lock:
+            register_file(self.target, self.var, self.run,
+                          self.hourly_target if self.hourly is not None else None)
+        if self.clipped:
+            print('%s: %s' % (self.var, '%d values out of the range of the packing clipped'
+                              % self.clipped))
+        return self.target
+
+    def abort(self):
+        with netcdf_lock:
+            if self.nc is not None:
+                self.nc.close()
+            if self.hourly is not None:
+                self.hourly.close()
+        # The steps of a live output which were published may be being read
+        if self.live:
+            return
+        if self.nc is not None:
+            os.remove(self.tmp)
+        if self.hourly is not None:
+            os.remove(self.hourly_tmp)
+
+
+def ingest_variable(var, run, files, folder='.', fmt='NETCDF3_64BIT_OFFSET', bbox=None,
+                    pack=False):
+    """Decode all the GRIB files of var and write them into the merged file
+    read by read_dataset, cropped to bbox if given, packed as int16 if pack.
+    Files are processed one step at a time, so that at most one step (all its
+    levels) is kept in memory."""
+    files_by_step = {}
+    for path in files:
+        files_by_step.setdefault(file_step(os.path.basename(path), run), []).append(path)
+
+    writer = OutputWriter(var, run, folder, fmt, bbox, pack)
+    try:
+        for step in sorted(files_by_step):
+            writer.write_step([message for path in files_by_step[step]
+                               for message in iter_messages(path)])
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def stream_variable(var, kind, run, folder='.', fmt='NETCDF3_64BIT_OFFSET', bbox=None,
+                    levels=None, workers=16, session=None, controller=None,
+                    retries=3, backoff=1., pack=False):
+    """Download, decompress and decode the GRIB files of var straight from the
+    server into the merged file, without writing any GRIB file on disk. The
+    bz2 data is decompressed while it is received and the messages are decoded
+    from memory. Files are downloaded concurrently but written in order of
+    step, so only the steps which arrived before their predecessors are kept
+    in memory."""
+    if session is None:
+        session = get_session(pool_size=workers)
+    urls = list_files(var, kind, run, session, levels)
+    if not urls:
+        raise ValueError('No files on the server for %s' % var)
+    urls_by_step = {}
+    for url in urls:
+        urls_by_step.setdefault(file_step(os.path.basename(url), run), []).append(url)
+    steps = sorted(urls_by_step)
+
+    def fetch(url):
+        data = download_file(url, session, retries, backoff, controller=controller,
+                             decompress=True)[0]
+        return decode_bytes(data)
+
+    writer = OutputWriter(var, run, folder, fmt, bbox, pack)
+    decoded = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(fetch, url), url)
+                           for step in steps for url in urls_by_step[step])
+            for future in as_completed(futures):
+                try:
+                    decoded[futures[future]] = future.result()
+                except Exception:
+                    # Don't download the other files for nothing
+                    for other in futures:
+                        other.cancel()
+                    raise
+                while steps and all(url in decoded for url in urls_by_step[steps[0]]):
+                    step = steps.pop(0)
+                    writer.write_step([message for url in urls_by_step[step]
+                                       for message in decoded.pop(url)])
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def ingest_run_variable(args):
+    """Ingest a variable if all its files are valid in the download manifest,
+    then remove the GRIB files as the cdo merging does."""
+    var, run, folder, fmt, bbox, pack = args
+    if os.path.isfile(os.path.join(folder, merged_file(var, run))):
+        return var, 'skipped'
+    incomplete = check_run(run, [var], folder, checksum=False)
+    if incomplete:
+        return var, 'incomplete'
+    files = [os.path.join(folder, name) for name in Manifest(run, folder).variables[var]]
+    ingest_variable(var, run, files, folder, fmt, bbox, pack)
+    for path in files:
+        os.remove(path)
+    return var, 'ingested'
+
+
+def ingest_invariant(args):
+    """Ingest a time-invariant field (e.g. hsurf) downloaded by
+    download_invariant_icon_d2, then remove the GRIB file."""
+    var, run, folder, fmt, bbox, pack = args
+    files = glob(os.path.join(folder, 'icon-d2_germany_regular-lat-lon_time-invariant_%s_*_%s.grib2'
+                              % (run, var)))
+    if not files:
+        return var, 'missing'
+    ingest_variable(var.upper(), run, files, folder, fmt, bbox, pack)
+    for path in files:
+        os.remove(path)
+    return var, 'ingested'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run to process (YYYYMMDDHH), defaults to the one exported by copy_data.run',
+                        required=False, default=get_run_from_env())
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be ingested',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be ingested',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-i', '--invariants', help='List of time-invariant variables to be ingested',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('--products', help='Ingest the variables needed by these plotting scripts (see products.py)',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-f', '--folder', help='Folder with the GRIB files where the output is written',
+                        required=False, default='.')
+    parser.add_argument('--format', help='Format of the NetCDF output files',
+                        required=False, default='NETCDF3_64BIT_OFFSET',
+                        choices=['NETCDF3_64BIT_OFFSET', 'NETCDF4'])
+    parser.add_argument('--pack', help='Store the variables of packed_ranges as int16 with a scale_factor and add_offset',
+                        required=False, action='store_true')
+    parser.add_argument('-c', '--cities', help='Cities of the meteograms which must be kept when cropping',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-m', '--crop_margin', help='Degrees added around the projections when cropping',
+                        required=False, default=1., type=float)
+    parser.add_argument('--no_crop', help='Keep the whole ICON-D2 domain',
+                        required=False, action='store_true')
+    parser.add_argument('-p', '--processes', help='Number of variables ingested in parallel',
+                        required=False, default=4, type=int)
+    parser.add_argument('-s', '--stream', help='Download and decode the files directly from the server, without writing GRIB files',
+                        required=False, action='store_true')
+    parser.add_argument('--levels', help='Pressure levels (hPa) of 3d variables to stream, e.g. t=500,850 fi=all',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-w', '--workers', help='Maximum number of concurrent downloads when streaming',
+                        required=False, default=16, type=int)
+    args = parser.parse_args()
+
+    if args.run is None:
+        parser.error('run not given and not found in the environment')
+
+    bbox = None
+    if not args.no_crop:
+        points = [get_city_coordinates(city) for city in args.cities]
+        if None in points:
+            # Better to keep the whole domain than to silently plot the wrong point
+            print('Coordinates of %s unknown, not cropping' %
+                  [c for c, p in zip(args.cities, points) if p is None])
+        else:
+            bbox = get_crop_bbox(points=points, margin=args.crop_margin)
+
+    levels = {}
+    if args.products:
+        plan = plan_fetch(args.products)
+        levels = dict((var, l) for var, l in plan['3d'].items()
+                      if l is not None and var not in args.vars_3d)
+        args.vars_2d += [var for var in plan['2d'] if var not in args.vars_2d]
+        args.vars_3d += [var for var in plan['3d'] if var not in args.vars_3d]
+        args.invariants += [var for var in plan['invariant'] if var not in args.invariants]
+
+    try:
+        levels.update(parse_levels(args.levels))
+    except ValueError as e:
+        parser.error(str(e))
+    args.vars_3d += [var for var in levels if var not in args.vars_3d]
+
+    if args.stream:
+        session = get_session(pool_size=args.workers)
+        # Shared by all the variables, so that the concurrency is bounded globally
+        controller = ConcurrencyController(maximum=args.workers)
+        kinds = [(var, '2d') for var in args.vars_2d] + [(var, '3d') for var in args.vars_3d]
+
+        def stream(variable):
+            var, kind = variable
+            if os.path.isfile(os.path.join(args.folder, merged_file(var, args.run))):
+                return var, 'skipped'
+            try:
+                stream_variable(var, kind, args.run, args.folder, args.format, bbox,
+                                levels.get(var), args.workers, session, controller,
+                                pack=args.pack)
+            except Exception as e:
+                print('%s: %s' % (var, e))
+                return var, 'incomplete'
+            return var, 'streamed'
+
+        with Pool(args.processes) as p:
+            results = p.map(ingest_invariant,
+                            [(var, args.run, args.folder, args.format, bbox, args.pack)
+                             for var in args.invariants])
+        with ThreadPoolExecutor(max_workers=args.processes) as executor:
+            results += list(executor.map(stream, kinds))
+        for var, status in results:
+            print('%s: %s' % (var, status))
+        sys.exit(1 if any(status == 'incomplete' for _, status in results) else 0)
+
+    variables = args.vars_2d + args.vars_3d
+    with Pool(args.processes) as p:
+        results = p.map(ingest_invariant,
+                        [(var, args.run, args.folder, args.format, bbox, args.pack)
+                         for var in args.invariants])
+        results += p.map(ingest_run_variable,
+                         [(var, args.run, args.folder, args.format, bbox, args.pack)
+                          for var in variables])
+    for var, status in results:
+        print('%s: %s' % (var, status))
+    if any(status == 'incomplete' for _, status in results):
+        sys.exit(1)
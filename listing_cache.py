@@ -0,0 +1,118 @@
+"""Download and parse the directory listings of the DWD opendata server.
+Listings are kept in a cache on disk keyed by url, and are only downloaded again
+when the server says that they changed (conditional GET with ETag/Last-Modified).
+This is shared between get_last_run.py and the download functions in
+functions_download_dwd.sh, which call this script as
+
+    python listing_cache.py <url> <regex>
+
+to print the urls of the files in the listing matching the regex."""
+import os
+import re
+import sys
+import json
+import hashlib
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup
+
+if 'LISTING_CACHE_FOLDER' in os.environ:
+    cache_folder = os.environ['LISTING_CACHE_FOLDER']
+elif 'MODEL_DATA_FOLDER' in os.environ:
+    cache_folder = os.path.join(os.environ['MODEL_DATA_FOLDER'], 'listing_cache')
+else:
+    cache_folder = '/tmp/icon-d2/listing_cache'
+
+
+def get_session(pool_size=8):
+    """Create a session with a pool of keep-alive connections that
+    can be shared between threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def parse_hrefs(response_text):
+    """Extract all the links from a directory listing."""
+    soup = BeautifulSoup(response_text, 'html.parser')
+    return [node.get('href') for node in soup.find_all('a') if node.get('href')]
+
+
+def cache_file(url):
+    """Path of the file where the listing of url is cached."""
+    return os.path.join(cache_folder,
+                        hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def read_cache(url):
+    try:
+        with open(cache_file(url)) as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    # Protect against (very unlikely) hash collisions
+    if entry.get('url') != url:
+        return None
+    return entry
+
+
+def write_cache(url, hrefs, etag=None, last_modified=None):
+    """Write the entry atomically so that concurrent processes never
+    read a partial file."""
+    if not os.path.isdir(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_folder, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'url': url, 'etag': etag, 'last_modified': last_modified,
+                   'hrefs': hrefs}, f)
+    os.replace(tmp, cache_file(url))
+
+
+def get_hrefs(url, params={}, session=None, cache=True):
+    """Return all the links in the listing at url. When cache is True the
+    request is conditional on the validators of the cached copy, which
+    is reused if the server answers 304 Not Modified."""
+    if session is None:
+        session = requests
+    entry = read_cache(url) if (cache and not params) else None
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    response = session.get(url, params=params, headers=headers)
+    if response.status_code == 304 and entry is not None:
+        return entry['hrefs']
+    if not response.ok:
+        return response.raise_for_status()
+    hrefs = parse_hrefs(response.text)
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    # Without validators the cached copy could never be reused
+    if cache and not params and (etag or last_modified):
+        write_cache(url, hrefs, etag, last_modified)
+    return hrefs
+
+
+def get_url_paths(url, ext='', prefix='', params={}, session=None, cache=True):
+    """Return the urls of the files in the listing at url filtered by
+    extension and prefix."""
+    return [url + href for href in get_hrefs(url, params, session, cache)
+            if href.endswith(ext) and href.startswith(prefix)]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print('Usage: %s <url> <regex>' % os.path.basename(sys.argv[0]),
+              file=sys.stderr)
+        sys.exit(1)
+    url, regex = sys.argv[1], sys.argv[2]
+    pattern = re.compile(regex)
+    for href in get_hrefs(url):
+        match = pattern.search(href)
+        if match:
+            print(url + match.group(0))
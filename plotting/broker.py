@@ -0,0 +1,134 @@
+"""Dataset broker: load once all the inputs of the maps of a run on the whole
+domain into shared memory, and serve them to the plotting scripts, which
+otherwise would each open, decode and load their own copy of the same
+variables (e.g. pmsl is read by five scripts on three projections).
+copy_data.run starts it before the plotting scripts as
+
+    python broker.py --products plot_cape.py plot_rain_clouds.py ... &
+
+read_dataset sends the variables and levels it needs on the socket
+broker.sock in the data folder and receives a dataset whose arrays are
+read-only views on the shared memory (see broker_dataset in utils.py),
+then cuts it to its projection as usual. When the broker is not running,
+or did not load the variables or levels requested, read_dataset reads the
+files. The shared memory is removed when the broker is terminated."""
+import sys
+import signal
+import argparse
+from multiprocessing.connection import Listener
+from utils import *
+
+sys.path.insert(0, home_folder)
+from products import plan_fetch
+
+
+def load_inputs(scripts, freq='1H'):
+    """Dataset with all the inputs of scripts in shared memory, only the
+    pressure levels needed by the products are loaded. If freq is one hour
+    the hourly views of the variables with sub-hourly output are loaded."""
+    plan = plan_fetch(scripts)
+    dset, run, _ = open_catalog(plan['2d'] + list(plan['3d']), mmap=read_mmap, freq=freq)
+    if plan['3d']:
+        # Descending like the levels requested by the scripts, so that
+        # selecting them gives views
+        levels = sorted(dset['plev'].values, reverse=True)
+        if None not in plan['3d'].values():
+            needed = set(l * 100 for var in plan['3d'].values() for l in var)
+            levels = [l for l in levels if l in needed]
+        dset = select_values(dset, 'plev', levels)
+    shared = SharedDataset(dset)
+
+    return shared, attach_dataset(shared.variables, shared.coords, shared.attrs, {}), run
+
+
+def serve(dset, run, hourly, request):
+    """Dataset and run of the variables and levels of request, as returned
+    by broker_dataset, or None if they were not all loaded"""
+    if request['run'] != run.strftime('%Y%m%d%H'):
+        return None
+    with open(folder + 'catalog.json') as f:
+        available = json.load(f)['runs'][request['run']]['variables']
+    entries = [available[v.lower()] for v in request['variables'] if v.lower() in available]
+    if any('hourly' in e for e in entries):
+        if request['hourly'] != hourly:
+            return None
+        if hourly:
+            entries = [e.get('hourly', e) for e in entries]
+    if any(e['name'] not in dset.data_vars for e in entries):
+        return None
+    loaded = dset['plev'].values.tolist() if 'plev' in dset.dims else []
+    if any(e['levels'] for e in entries):
+        # All the levels are returned when level is not given
+        if request['level'] is None and any(l not in loaded for e in entries
+                                            for l in e['levels'] or []):
+            return None
+        if request['level'] is not None and not all(np.isclose(loaded, l).any()
+                                                    for l in np.atleast_1d(request['level'])):
+            return None
+    if request['level'] is None:
+        entries = [dict(e, levels=[l for l in loaded if l in e['levels']] if e['levels'] else None)
+                   for e in entries]
+    else:
+        # read_dataset selects the levels in the order requested, keep the
+        # order of the loaded ones which is the one of the scripts
+        levels = [l for l in loaded if any(l in e['levels'] for e in entries if e['levels'])]
+        entries = [dict(e, levels=levels if e['levels'] else None) for e in entries]
+    ds = select_entries(dset[[e['name'] for e in entries]], entries)
+
+    return SharedDatasetChunk(SharedDataset(ds, copy=False), {}), run
+
+
+# Set on SIGTERM by terminate, the broker stops serving and removes the
+# shared memory
+stopped = False
+listener = None
+
+
+def terminate(signum, frame):
+    """Stop serving: closing the listener interrupts the accept of the loop"""
+    global stopped
+    stopped = True
+    if listener is not None:
+        listener.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--products', help='Plotting scripts whose inputs are loaded, all of them by default',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('--freq', help='Frequency of the data read by the scripts, the hourly views are loaded if it is one hour',
+                        required=False, default='1H')
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, terminate)
+    shared, dset, run = load_inputs(args.products, args.freq)
+    print_message('Broker serving %d variables of run %s (%.0f MB)' %
+                  (len(dset.data_vars), run.strftime('%Y%m%d%H'), dset.nbytes / 1e6))
+    # The socket only exists once the data is loaded
+    listener = Listener(broker_address, family='AF_UNIX')
+    try:
+        while not stopped:
+            try:
+                conn = listener.accept()
+            except OSError:
+                if stopped:
+                    break
+                raise
+            with conn:
+                try:
+                    request = conn.recv()
+                except (OSError, EOFError):
+                    continue
+                try:
+                    served = serve(dset, run, is_hourly(args.freq), request)
+                except Exception as e:
+                    # The script reads the files instead, the broker keeps serving the others
+                    print_message('Broker could not serve %s: %r' % (request, e))
+                    served = None
+                try:
+                    conn.send(served)
+                except (OSError, EOFError):
+                    continue
+    finally:
+        listener.close()
+        shared.close()
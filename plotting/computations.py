@@ -1,8 +1,93 @@
+import os
+import json
+import fcntl
+import hashlib
+import inspect
+from functools import wraps
 import metpy.calc as mpcalc
 import xarray as xr
 from metpy.units import units
 from utils import *
 
+# Keep the derived variables computed on the whole domain in the data folder
+# (see cached), DERIVED_CACHE=false computes them every time
+derived_cache = os.environ.get('DERIVED_CACHE', 'true') == 'true'
+
+
+def derived_key(dset, function, names, params):
+    """What the variables derived by function from the variables names of dset
+    depend on: the run, the parameters and the levels, units and times of
+    the inputs, and whether they are computed with NumPy or MetPy"""
+    key = {'run': pd.to_datetime(dset['run'].values).strftime('%Y%m%d%H'),
+           'function': function.__name__,
+           'fast': fast_computations,
+           'params': params,
+           'inputs': dict((name, {'levels': dset[name]['plev'].values.tolist()
+                                  if 'plev' in dset[name].dims else None,
+                                  'units': str(dset[name].attrs.get('units'))})
+                          for name in names),
+           'times': [str(t) for t in dset['time'].values] if 'time' in dset.dims else None}
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    return key, folder + 'derived_%s_%s_%s.nc' % (key['run'], function.__name__, digest)
+
+
+def write_derived(dset, function, names, args, kwargs, key, path):
+    """Compute the variables derived by function on the whole domain, reading
+    the inputs like dset was read, and write them to path"""
+    full = read_dataset(**json.loads(dset.attrs['read_dataset']))
+    for name in names:
+        # The scripts may have converted the inputs before the computation
+        if full[name].attrs.get('units') != dset[name].attrs.get('units'):
+            convert_units(full[name], dset[name].attrs['units'])
+    full = full[names + ['run']]
+    result = function(full, *args, **kwargs)
+    derived = result[[v for v in result.data_vars if v not in full.data_vars]]
+    derived = derived.drop_vars([c for c in derived.coords if c not in derived.dims])
+    for var in derived.data_vars:
+        derived[var].attrs = dict((k, str(v)) for k, v in derived[var].attrs.items())
+    derived.attrs = {'key': json.dumps(key, sort_keys=True)}
+    derived.to_netcdf(path + '.tmp',
+                      encoding=dict((v, {'zlib': True, 'complevel': 1}) for v in derived.data_vars))
+    os.replace(path + '.tmp', path)
+
+
+def cached(*inputs):
+    """Decorate a computation which adds variables to the dataset computed
+    point by point from the variables inputs (or from the ones given by
+    the parameters named inputs), so that they are computed once per run on
+    the whole domain and persisted in the data folder: the other products
+    and projections only read them and cut them to their domain."""
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def wrapper(dset, *args, **kwargs):
+            if not derived_cache or 'read_dataset' not in dset.attrs:
+                return function(dset, *args, **kwargs)
+            params = signature.bind(dset, *args, **kwargs)
+            params.apply_defaults()
+            params = dict((k, v) for k, v in params.arguments.items() if k != 'dset')
+            names = [params.get(i, i) for i in inputs]
+            names = [name for name in names if name in dset.data_vars]
+            key, path = derived_key(dset, function, names, params)
+            # Wait for the other scripts computing the same variables
+            with open(path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    if not os.path.isfile(path):
+                        write_derived(dset, function, names, args, kwargs, key, path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            derived = xr.open_dataset(path, chunks={})
+            derived = derived.sel(lat=slice(dset['lat'].values[0], dset['lat'].values[-1]),
+                                  lon=slice(dset['lon'].values[0], dset['lon'].values[-1]))
+            derived.attrs = {}
+
+            return xr.merge([dset, derived])
+        return wrapper
+    return decorator
+
 
 def compute_convergence(dset, uvar='10u', vvar='10v'):
     dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'], dset['lat'])
@@ -32,11 +117,69 @@ def compute_vorticity(dset, uvar='10u', vvar='10v'):
     return xr.merge([dset, vort])
 
 
+# Constants of the NumPy computations (fast_computations), the values of MetPy
+earth_radius = 6371008.7714  # m
+earth_gravity = 9.80665  # m s-2
+epsilon = 0.6219569100577033  # molecular weight ratio of water and dry air
+kappa = 2. / 7.  # Rd / cp of dry air
+water_triple_point = 273.16  # K
+water_gas_constant = 461.52311572606084  # J kg-1 K-1
+water_latent_heat = 2500840.  # J kg-1, of vaporization at the triple point
+water_heat_capacity = 4219.4 - 1860.078011865639  # J kg-1 K-1, liquid minus vapor
+
+
+def fast_geopotential_height(geopotential):
+    """Height in m of geopotential in m2 s-2 as in
+    mpcalc.geopotential_to_height, with NumPy on arrays or DataArrays"""
+    return geopotential * earth_radius / (earth_gravity * earth_radius - geopotential)
+
+
+def fast_saturation_vapor_pressure(temperature):
+    """Saturation vapor pressure in hPa over liquid water at temperature in
+    K (Ambaum 2020) as in mpcalc.saturation_vapor_pressure"""
+    latent_heat = water_latent_heat - water_heat_capacity * (temperature - water_triple_point)
+    return 6.112 * (water_triple_point / temperature) ** (water_heat_capacity / water_gas_constant) * \
+        np.exp((water_latent_heat / water_triple_point - latent_heat / temperature) / water_gas_constant)
+
+
+def fast_thetae(temperature, relative_humidity, pressure):
+    """Equivalent potential temperature in K (Bolton 1980) at pressure in
+    hPa of temperature in K and relative_humidity in %, as
+    mpcalc.equivalent_potential_temperature of the dewpoint given by
+    mpcalc.dewpoint_from_relative_humidity, with NumPy on arrays or
+    DataArrays"""
+    vapor = np.log(relative_humidity / 100. * fast_saturation_vapor_pressure(temperature) / 6.112)
+    dewpoint = 273.15 + 243.5 * vapor / (17.67 - vapor)
+    e = fast_saturation_vapor_pressure(dewpoint)
+    mixing_ratio = epsilon * e / (pressure - e)
+    t_l = 56. + 1. / (1. / (dewpoint - 56.) + np.log(temperature / dewpoint) / 800.)
+    th_l = temperature * (1000. / (pressure - e)) ** kappa * \
+        (temperature / t_l) ** (0.28 * mixing_ratio)
+    return th_l * np.exp(mixing_ratio * (1. + 0.448 * mixing_ratio) * (3036. / t_l - 1.78))
+
+
+def fast_wind_speed(u, v):
+    """Wind speed in km/h of the components u and v in m/s, with NumPy on
+    arrays or DataArrays"""
+    return np.hypot(u, v) * 3.6
+
+
+def has_units(data, *names):
+    return data.attrs.get('units') in names
+
+
+@cached('zvar')
 def compute_geopot_height(dset, zvar='z', level=None):
     if level:
         zlevel = dset[zvar].sel(plev=level)
     else:
         zlevel = dset[zvar]
+    if fast_computations and has_units(zlevel, 'm**2 s**-2', 'm2 s-2'):
+        gph = xr.DataArray(fast_geopotential_height(zlevel),
+                           attrs={'standard_name': 'geopotential height',
+                                  'units': 'meter'},
+                           name='geop')
+        return xr.merge([dset, gph])
     gph = mpcalc.geopotential_to_height(zlevel)
     gph = xr.DataArray(gph.magnitude,
                        coords=zlevel.coords,
@@ -47,15 +190,22 @@ def compute_geopot_height(dset, zvar='z', level=None):
     return xr.merge([dset, gph])
 
 
+@cached('tvar', 'rvar')
 def compute_thetae(dset, tvar='t', rvar='r'):
-    rh = mpcalc.dewpoint_from_relative_humidity(dset['t'],
-                                                dset['r'] / 100.)
+    if fast_computations and has_units(dset[tvar], 'K') and has_units(dset[rvar], '%'):
+        theta_e = xr.DataArray(fast_thetae(dset[tvar], dset[rvar], 850.) - 273.15,
+                               attrs={'standard_name': 'Equivalent potential temperature',
+                                      'units': 'degree_Celsius'},
+                               name='theta_e')
+        return xr.merge([dset, theta_e])
+    rh = mpcalc.dewpoint_from_relative_humidity(dset[tvar],
+                                                dset[rvar] / 100.)
     theta_e = mpcalc.equivalent_potential_temperature(850 * units.hPa,
-                                                      dset['t'],
+                                                      dset[tvar],
                                                       rh).to('degC')
 
     theta_e = xr.DataArray(theta_e.magnitude,
-                           coords= dset['t'].coords,
+                           coords= dset[tvar].coords,
                            attrs={'standard_name': 'Equivalent potential temperature',
                                   'units': theta_e.units},
                             name='theta_e')
@@ -63,6 +213,7 @@ def compute_thetae(dset, tvar='t', rvar='r'):
     return xr.merge([dset, theta_e])
 
 
+@cached('snowvar')
 def compute_snow_change(dset, snowvar='sde'):
     hsnow_acc = dset[snowvar]
     hsnow = (hsnow_acc - hsnow_acc[0, :, :])
@@ -77,6 +228,53 @@ def compute_snow_change(dset, snowvar='sde'):
     return xr.merge([dset, hsnow])
 
 
+# Windows of the precipitation totals in hours, 'start' is since the first time
+accumulation_windows = {'1h': 1, '3h': 3, '6h': 6, '12h': 12, '24h': 24, 'start': None}
+
+
+def window_starts(times, windows):
+    """Position in times of the start of every window ending at every time,
+    -1 where the window starts before the first time or at a time which
+    is not one of the times"""
+    times = pd.DatetimeIndex(times)
+    starts = []
+    for window in windows:
+        hours = accumulation_windows[window]
+        if hours is None:
+            starts.append(np.zeros(len(times), dtype=int))
+        else:
+            starts.append(times.get_indexer(times - pd.Timedelta(hours=hours)))
+
+    return np.array(starts).reshape(len(windows), len(times))
+
+
+def accumulate(acc, windows=tuple(accumulation_windows)):
+    """Totals of the accumulated DataArray acc over the windows ending at
+    every one of its times, as a DataArray with a window dimension: the
+    difference of acc with acc at the start of every window, selected by
+    position for all the windows at once, so that it stays lazy on dask
+    arrays. The totals are NaN where the window starts before the first
+    time."""
+    starts = window_starts(acc['time'].values, windows)
+    indexer = xr.DataArray(np.maximum(starts, 0), dims=('window', 'end'))
+    start_values = acc.isel(time=indexer).drop_vars('time').rename({'end': 'time'})
+    valid = xr.DataArray(starts >= 0, dims=('window', 'time'))
+    totals = (acc - start_values).where(valid).transpose('window', *acc.dims)
+    totals.attrs = acc.attrs
+
+    return totals.assign_coords(window=list(windows))
+
+
+def compute_accumulations(dset, var='tp', windows=tuple(accumulation_windows)):
+    """Add the totals of the accumulated variable var over the windows (see
+    accumulate) to dset, as the variables <var>_<window>"""
+    totals = accumulate(dset[var], windows)
+    totals = [totals.sel(window=window, drop=True).rename('%s_%s' % (var, window))
+              for window in windows]
+
+    return xr.merge([dset] + totals)
+
+
 def compute_rain_snow_change(dset):
     try:
         rain_acc = dset['RAIN_GSP'] + dset['RAIN_CON']
@@ -87,8 +285,8 @@ def compute_rain_snow_change(dset):
     except:
         snow_acc = dset['SNOW_GSP']
 
-    rain = (rain_acc - rain_acc[0, :, :])
-    snow = (snow_acc - snow_acc[0, :, :])
+    rain = accumulate(rain_acc, ['start']).sel(window='start', drop=True)
+    snow = accumulate(snow_acc, ['start']).sel(window='start', drop=True)
 
     rain = xr.DataArray(rain, name='rain_increment')
     snow = xr.DataArray(snow, name='snow_increment')
@@ -97,6 +295,13 @@ def compute_rain_snow_change(dset):
 
 
 def compute_wind_speed(dset, uvar='u', vvar='v'):
+    if fast_computations and all(has_units(dset[var], 'm s**-1', 'm s-1', 'm/s')
+                                 for var in (uvar, vvar)):
+        wind = xr.DataArray(fast_wind_speed(dset[uvar], dset[vvar]),
+                            attrs={'standard_name': 'wind intensity',
+                                   'units': 'kilometer_per_hour'},
+                            name='wind_speed')
+        return xr.merge([dset, wind])
     wind = mpcalc.wind_speed(dset[uvar], dset[vvar]).to(units.kph)
     wind = xr.DataArray(wind, coords=dset[uvar].coords,
                            attrs={'standard_name': 'wind intensity',
@@ -106,8 +311,74 @@ def compute_wind_speed(dset, uvar='u', vvar='v'):
     return xr.merge([dset, wind])
 
 
-def compute_rate(dset):
-    '''Given an accumulated variable compute the step rate'''
+def rate_frame(frame, values):
+    """DataArray of the rate values at the time of frame, without the
+    attributes of the accumulated variable like differentiate"""
+    return xr.DataArray(values, coords=frame.coords, dims=frame.dims, name=frame.name)
+
+
+def step_rates(frames, centred=True):
+    """Rates per hour of an accumulated variable given its frames (DataArrays
+    of one time, in time order, e.g. as they are written), yielded one frame
+    at a time: only the last frame and its rate are kept in memory.
+    With centred=True the rates are the ones of
+    differentiate(coord='time', datetime_unit='h'): the difference centred
+    on the step, weighted by the two time steps, forward on the first step
+    and backward on the last one. The rate of a step is the mean of the
+    rates of the time steps before and after it, so it is yielded when the
+    next frame is given, and the one of the last step at the end.
+    With centred=False the rate of a step is the one of the time step
+    before it, yielded as soon as its frame is given; the first step has
+    the rate of the second one, like the forward difference. One frame gives
+    no rate."""
+    last, rate, hours = None, None, None
+    for frame in frames:
+        frame = frame.load()
+        if last is not None:
+            step = float((frame['time'].values - last['time'].values) / np.timedelta64(1, 'h'))
+            backward = (frame.values - last.values) / step
+            if rate is None:
+                yield rate_frame(last, backward)
+            elif centred:
+                yield rate_frame(last, (step * rate + hours * backward) / (hours + step))
+            if not centred:
+                yield rate_frame(frame, backward)
+            rate, hours = backward, step
+        last = frame
+    if centred and rate is not None:
+        yield rate_frame(last, rate)
+
+
+def rate_series(acc, indices=None):
+    """Rates of the times of the accumulated DataArray acc given by
+    step_rates, NaN if acc has a single time. With indices only the rates
+    of these times are computed, from their frames and the ones next to
+    them, and the others are NaN. The input is read one frame at a time,
+    but the result holds all the frames."""
+    n = acc.sizes['time']
+    indices = sorted(set(range(n) if indices is None else indices))
+    values = np.full(acc.shape, np.nan, dtype=acc.dtype)
+    # Every block of consecutive indices is fed to step_rates with the
+    # frames before and after it, whose one-sided rates are not kept
+    blocks = []
+    for i in indices:
+        if blocks and blocks[-1][1] == i - 1:
+            blocks[-1][1] = i
+        else:
+            blocks.append([i, i])
+    for first, last in blocks:
+        times = range(max(first - 1, 0), min(last + 1, n - 1) + 1)
+        rates = step_rates(acc.isel(time=i) for i in times)
+        for i, rate in zip(times, rates):
+            if first <= i <= last:
+                values[i] = rate.values
+    return xr.DataArray(values, coords=acc.coords, dims=acc.dims, name=acc.name)
+
+
+@cached('RAIN_GSP', 'RAIN_CON', 'SNOW_GSP', 'SNOW_CON')
+def compute_rate(dset, steps=None):
+    '''Given an accumulated variable compute the step rate, only at the
+    forecast hours steps if given (e.g. plot_steps)'''
     try:
         rain_acc = dset['RAIN_GSP'] + dset['RAIN_CON']
     except:
@@ -117,8 +388,12 @@ def compute_rate(dset):
     except:
         snow_acc = dset['SNOW_GSP']
 
-    rain = rain_acc.load().differentiate(coord="time", datetime_unit="h")
-    snow = snow_acc.load().differentiate(coord="time", datetime_unit="h")
+    indices = None
+    if steps is not None:
+        _, _, cum_hour = get_time_run_cum(dset)
+        indices = np.flatnonzero(np.isin(cum_hour, steps))
+    rain = rate_series(rain_acc, indices)
+    snow = rate_series(snow_acc, indices)
 
     rain = xr.DataArray(rain, name='rain_rate')
     snow = xr.DataArray(snow, name='snow_rate')
@@ -1,6 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
 
@@ -54,11 +52,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(0, 2)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
@@ -1,6 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
 from computations import compute_geopot_height
@@ -59,11 +57,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(0, 2)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
@@ -71,7 +67,7 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['t'].metpy.convert_units('degC')
+        convert_units(data['t'], 'degC')
         time, run, cum_hour = get_time_run_cum(data)
         # Build the name of the output image
         filename = subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
@@ -1,6 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
 from computations import compute_snow_change
@@ -34,8 +32,8 @@ def main():
     This is not included in utils.py as it can change from case to case."""
     dset = read_dataset(variables=['h_snow', 'snowlmt'],
                         projection=projection)
-    dset['sde'].metpy.convert_units('cm')
-    dset['SNOWLMT'].metpy.convert_units('m')
+    convert_units(dset['sde'], 'cm')
+    convert_units(dset['SNOWLMT'], 'm')
 
     dset = compute_snow_change(dset)
 
@@ -68,11 +66,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(-2, -1)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes 
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
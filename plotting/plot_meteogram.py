@@ -26,17 +26,13 @@ else:
 
 
 def main():
-    dset = read_dataset(variables=['t_2m', 'td_2m', 't', 'vmax_10m',
-                                   'pmsl', 'HSURF', 'ww', 'rain_gsp', 'rain_con',
-                                   'snow_gsp', 'snow_con', 'relhum', 'u', 'v', 'clc'], freq=None)
     # Subset dataset on cities and create iterator
-    it = []
-    for city in cities:
-        lon, lat = get_city_coordinates(city)
-        d = dset.sel(lon=lon, lat=lat, method='nearest').copy()
+    it = read_points(variables=['t_2m', 'td_2m', 't', 'vmax_10m',
+                                'pmsl', 'HSURF', 'ww', 'rain_gsp',
+                                'snow_gsp', 'relhum', 'u', 'v'],
+                     coordinates=[get_city_coordinates(city) for city in cities])
+    for city, d in zip(cities, it):
         d.attrs['city'] = city
-        it.append(d)
-        del d
 
     process_map(plot, it, max_workers=processes, chunksize=2)
 
@@ -48,16 +44,16 @@ def plot(dset_city):
     time_hourly, run, cum_hour = get_time_run_cum(dset_hourly)
     time_prec, _, _ = get_time_run_cum(dset_city)
     t = dset_hourly['t']
-    t.metpy.convert_units('degC')
+    convert_units(t, 'degC')
     rh = dset_hourly['r']
     t2m = dset_hourly['2t']
-    t2m.metpy.convert_units('degC')
+    convert_units(t2m, 'degC')
     td2m = dset_hourly['2d']
-    td2m.metpy.convert_units('degC')
+    convert_units(td2m, 'degC')
     vmax_10m = dset_hourly['VMAX_10M']
-    vmax_10m.metpy.convert_units('kph')
+    convert_units(vmax_10m, 'kph')
     pmsl = dset_hourly['prmsl']
-    pmsl.metpy.convert_units('hPa')
+    convert_units(pmsl, 'hPa')
     plevs = dset_hourly['t'].metpy.vertical.metpy.unit_array.to('hPa').magnitude
 
     rain_acc = dset_city['RAIN_GSP']
@@ -1,8 +1,7 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
+from computations import compute_accumulations
 import metpy.calc as mpcalc
 
 debug = False
@@ -32,7 +31,8 @@ def main():
     This is not included in utils.py as it can change from case to case."""
     dset = read_dataset(variables=['tot_prec', 'pmsl'],
                         projection=projection)
-    dset['prmsl'].metpy.convert_units('hPa')
+    dset = compute_accumulations(dset, 'tp', ['start'])
+    convert_units(dset['prmsl'], 'hPa')
 
     levels_precip = list(np.arange(1, 50, 0.4)) + \
                     list(np.arange(51, 100, 2)) +\
@@ -65,11 +65,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(2, 4)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
@@ -82,7 +80,7 @@ def plot_files(dss, **args):
         filename = subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
 
         cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['tp'],
+                                 data['tp_start'],
                                  extend='max',
                                  cmap=args['cmap'],
                                  norm=args['norm'],
@@ -1,8 +1,7 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
+from computations import compute_accumulations
 
 debug = False
 if not debug:
@@ -39,8 +38,10 @@ def main():
                     list(np.arange(501, 1000, 50)) + \
                     list(np.arange(1001, 2000, 100))
 
-    dset = dset.resample(time="24H",
-                         base=dset.time[0].dt.hour.item()).nearest().diff(dim='time')
+    # Totals of the 24 hours ending every 24 hours from the first time
+    hours = (dset['time'] - dset['time'][0]) / np.timedelta64(1, 'h')
+    dset = dset.isel(time=(hours % 24 == 0).values)
+    dset = compute_accumulations(dset, 'tp', ['24h']).isel(time=slice(1, None))
 
     cmap, norm = get_colormap_norm('rain_acc_wxcharts', levels=levels_precip)
 
@@ -51,7 +52,7 @@ def main():
     # additional maps adjustment for this map
     m.arcgisimage(service='World_Shaded_Relief', xpixels = 1500)
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.drop(['lon', 'lat', 'tp']).load()
 
     # All the arguments that need to be passed to the plotting function
     args=dict(x=x, y=y, ax=ax,
@@ -62,11 +63,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(-2, -1)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
@@ -78,7 +77,7 @@ def plot_files(dss, **args):
         filename = subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
 
         cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['tp'],
+                                 data['tp_24h'],
                                  extend='max',
                                  cmap=args['cmap'],
                                  norm=args['norm'],
@@ -1,6 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
 from computations import compute_rate
@@ -35,10 +33,9 @@ def main():
                                     'snow_gsp',
                                     'pmsl', 'clcl', 'clch'],
                                     projection=projection)
-    # Convert to hourly data
-    dset = dset.resample(time="1H").nearest(tolerance="1H")
-    dset = compute_rate(dset)
-    dset['prmsl'].metpy.convert_units('hPa')
+    # Only the rates of the frames to plot are computed
+    dset = compute_rate(dset, steps=plot_steps)
+    convert_units(dset['prmsl'], 'hPa')
 
     levels_rain  = (0.1, 0.2, 0.4, 0.6, 0.8, 1., 1.5, 2., 2.5, 3.0, 4.,
                     5, 7.5, 10., 15., 20., 30., 40., 60., 80., 100., 120.)
@@ -76,11 +73,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(10, 12)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
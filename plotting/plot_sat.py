@@ -1,6 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
 from computations import compute_rate
@@ -31,14 +29,14 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = read_dataset(variables=['rain_gsp','rain_con',
-                                    'snow_gsp', 'snow_con',
+    dset = read_dataset(variables=['rain_gsp',
+                                    'snow_gsp',
                                     'pmsl', 'synmsg_bt_cl_ir10.8'],
                                     projection=projection)
 
     #dset = compute_rate(dset)
-    dset['prmsl'].metpy.convert_units('hPa')
-    dset['SYNMSG_BT_CL_IR10.8'].metpy.convert_units('degC')
+    convert_units(dset['prmsl'], 'hPa')
+    convert_units(dset['SYNMSG_BT_CL_IR10.8'], 'degC')
 
     levels_rain  = (0.1, 0.2, 0.4, 0.6, 0.8, 1., 1.5, 2., 2.5, 3.0, 4.,
                     5, 7.5, 10., 15., 20., 30., 40., 60., 80., 100., 120.)
@@ -76,11 +74,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(0, 2)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
@@ -1,6 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
 
@@ -29,8 +27,8 @@ def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
     dset = read_dataset(variables=['t', 'pmsl'], level=85000, projection=projection)
-    dset.t.metpy.convert_units('degC')
-    dset.prmsl.metpy.convert_units('hPa')
+    convert_units(dset.t, 'degC')
+    convert_units(dset.prmsl, 'hPa')
 
     levels_temp = np.arange(-25., 25., 1.)
     cmap = get_colormap('temp')
@@ -55,11 +53,9 @@ def main():
     if debug:
         plot_files(dset_level.isel(time=slice(0, 2)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes 
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 
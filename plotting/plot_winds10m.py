@@ -1,6 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
 import metpy.calc as mpcalc
@@ -33,8 +31,8 @@ def main():
     dset = read_dataset(variables=['vmax_10m', 'pmsl', 'u_10m', 'v_10m'],
                         projection=projection)
 
-    dset['VMAX_10M'].metpy.convert_units('kph')
-    dset['prmsl'].metpy.convert_units('hPa')
+    convert_units(dset['VMAX_10M'], 'kph')
+    convert_units(dset['prmsl'], 'hPa')
 
     levels_winds_10m = np.arange(20., 150., 5.)
 
@@ -63,11 +61,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(0, 2)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
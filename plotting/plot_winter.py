@@ -1,9 +1,7 @@
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 from utils import *
 import sys
-from computations import compute_snow_change
+from computations import compute_snow_change, accumulate
 
 debug = False
 if not debug:
@@ -32,16 +30,15 @@ def main():
     This is not included in utils.py as it can change from case to case."""
     dset = read_dataset(variables=['rain_gsp', 'h_snow', 'snowlmt'],
                         projection=projection)
-    dset = dset.resample(time="1H").nearest(tolerance="1H")
 
-    rain = (dset['RAIN_GSP'] - dset['RAIN_GSP'][0, :, :])
+    rain = accumulate(dset['RAIN_GSP'], ['start']).sel(window='start', drop=True)
     rain = xr.DataArray(rain, name='rain_increment')
 
-    dset.sde.metpy.convert_units('cm')
+    convert_units(dset.sde, 'cm')
     dset = compute_snow_change(dset)
 
     dset = xr.merge([dset, rain])
-    dset['SNOWLMT'].metpy.convert_units('m')
+    convert_units(dset['SNOWLMT'], 'm')
 
     levels_snow = (0.25, 0.5, 1, 2.5, 5, 10, 15, 20, 25, 30, 40, 50, 70, 90, 150)
     levels_rain = (10, 15, 25, 35, 50, 75, 100, 125, 150)
@@ -69,11 +66,9 @@ def main():
     if debug:
         plot_files(dset.isel(time=slice(-2, -1)), **args)
     else:
-        # Parallelize the plotting by dividing into chunks and processes 
-        dss = chunks_dataset(dset, chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(processes)
-        p.map(plot_files_param, dss)
+        # Parallelize the plotting by dividing into chunks and processes,
+        # the data is passed to the processes in shared memory
+        plot_parallel(plot_files, dset, **args)
 
 
 def plot_files(dss, **args):
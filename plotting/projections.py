@@ -0,0 +1,36 @@
+"""Extents of the maps produced for every projection. This is kept separate
+from utils.py so that it can be imported without the plotting libraries, e.g.
+by ingest.py to crop the data to the area which is actually plotted."""
+
+proj_defs = {
+    'nord':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 4,
+        'llcrnrlat': 50,
+        'urcrnrlon': 12,
+        'urcrnrlat': 56,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'it':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 5.5,
+        'llcrnrlat': 43.5,
+        'urcrnrlon': 14.5,
+        'urcrnrlat': 48,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'de':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 4.5,
+        'llcrnrlat': 46.5,
+        'urcrnrlon': 16,
+        'urcrnrlat': 56,
+        'resolution': 'i',
+        'epsg': 4269
+    }
+}
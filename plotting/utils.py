@@ -18,6 +18,12 @@ from matplotlib.image import imread as read_png
 import requests
 import json
 import matplotlib.pyplot as plt
+from functools import partial
+from multiprocessing import Pool, shared_memory
+from multiprocessing.connection import Client
+from mmap import mmap as map_file, ACCESS_READ
+from scipy.io import netcdf_file
+from projections import proj_defs
 
 import warnings
 warnings.filterwarnings(
@@ -33,12 +39,30 @@ if 'MODEL_DATA_FOLDER' in os.environ:
 else:
     folder = '/tmp/icon-d2/'
 folder_images = folder
+# Memory map the NetCDF3 files instead of reading them (see open_mapped)
+read_mmap = os.environ.get('READ_MMAP', 'false') == 'true'
+# Compute the derived variables and the unit conversions with NumPy in float32
+# instead of MetPy and pint (see convert_units and computations.py)
+fast_computations = os.environ.get('FAST_COMPUTATIONS', 'false') == 'true'
+# Socket of the dataset broker (see broker.py), the data is read from the
+# files when it is not running
+broker_address = folder + 'broker.sock'
 chunks_size = 10
 processes = 9
 figsize_x = 11
 figsize_y = 9
 invariant_file = folder+'hsurf_*.nc'
 
+# Forecast hours to be plotted (e.g. "0-12" or "13,14"), all of them if not defined.
+# This is set by watch_run.py to render only the frames whose inputs are complete
+if 'PLOT_STEPS' in os.environ:
+    plot_steps = []
+    for steps in os.environ['PLOT_STEPS'].split(','):
+        first, _, last = steps.partition('-')
+        plot_steps += list(range(int(first), int(last or first) + 1))
+else:
+    plot_steps = None
+
 if "HOME_FOLDER" in os.environ:
     home_folder = os.environ['HOME_FOLDER']
 else:
@@ -107,40 +131,6 @@ WMO_GLYPH_LOOKUP_PNG={
         '95': '25',
 }
 
-proj_defs = {
-    'nord':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 4,
-        'llcrnrlat': 50,
-        'urcrnrlon': 12,
-        'urcrnrlat': 56,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'it':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 5.5,
-        'llcrnrlat': 43.5,
-        'urcrnrlon': 14.5,
-        'urcrnrlat': 48,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'de':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 4.5,
-        'llcrnrlat': 46.5,
-        'urcrnrlon': 16,
-        'urcrnrlat': 56,
-        'resolution': 'i',
-        'epsg': 4269
-    }
-}
-
-
 def get_weather_icons(ww, time):
     """
     Get the path to a png given the weather representation 
@@ -171,28 +161,51 @@ def get_weather_icons(ww, time):
 
 
 def read_dataset(variables = ['T_2M', 'TD_2M'], level=None, projection=None,
-                 engine='scipy', freq='1H'):
-    """Wrapper to initialize the dataset"""
-    # Create the regex for the files with the needed variables
-    variables_search = '('+'|'.join(variables)+')'
-    # Get a list of all the files in the folder
-    # In the future we can use Run/Date to have a more selective glob pattern
-    files = glob(folder+'*.nc')
-    run = pd.to_datetime(re.findall(r'(?:\d{10})', files[0])[0],
-               format='%Y%m%d%H')
-    # find only the files with the variables that we need 
-    needed_files = [f for f in files if re.search(r'/%s(?:_\d{10})' % variables_search, f)]
-    dset = xr.open_mfdataset(needed_files,
-                             preprocess=preprocess,
-                             engine=engine)
+                 engine='scipy', freq='1H', layout='maps', mmap=None):
+    """Wrapper to initialize the dataset. With layout='points' the time-series
+    store is used if it exists, which is much faster to read at single points
+    (see read_points). With mmap=True (READ_MMAP=true in the environment by
+    default) the NETCDF3 files of the catalog are memory mapped, and the
+    arrays are read-only views on them (see open_mapped). When the broker
+    is running the maps are read-only views on its shared memory instead
+    (see broker_dataset)."""
+    if mmap is None:
+        mmap = read_mmap
+    served = None
+    if os.path.isfile(folder + 'catalog.json'):
+        if layout == 'maps':
+            served = broker_dataset(variables, level, freq)
+        if served:
+            dset, run = served
+        else:
+            # Files of the run registered at ingest
+            dset, run, layout = open_catalog(variables, layout, engine, mmap, freq)
+    else:
+        # Create the regex for the files with the needed variables
+        variables_search = '('+'|'.join(variables)+')'
+        # Get a list of all the files in the folder
+        # In the future we can use Run/Date to have a more selective glob pattern
+        files = glob(folder+'*.nc')
+        run = pd.to_datetime(re.findall(r'(?:\d{10})', files[0])[0],
+                   format='%Y%m%d%H')
+        # find only the files with the variables that we need 
+        needed_files = [f for f in files if re.search(r'/%s(?:_\d{10})' % variables_search, f)]
+        dset = xr.open_mfdataset(needed_files,
+                                 preprocess=preprocess,
+                                 engine=engine)
     # NOTE!! Even though we use open_mfdataset, which creates a Dask array, we then 
     # load the dataset into memory since otherwise the object cannot be pickled by 
     # multiprocessing
     dset = dset.metpy.parse_cf()
-    if freq:
+    # The hourly views written at ingest are already every hour
+    if freq and not has_frequency(dset, freq):
         dset = dset.resample(time=freq).nearest(tolerance='1H')
     if level:
-        dset = dset.sel(plev=level, method='nearest')
+        check_levels(dset, level)
+        if np.ndim(level):
+            dset = select_values(dset, 'plev', level, method='nearest')
+        else:
+            dset = dset.sel(plev=level, method='nearest')
     if projection:
         proj_options = proj_defs[projection]
         dset = dset.sel(lat=slice(proj_options['llcrnrlat'],
@@ -201,14 +214,221 @@ def read_dataset(variables = ['T_2M', 'TD_2M'], level=None, projection=None,
                                   proj_options['urcrnrlon']))
     dset['run'] = run
 
-    # chunk now based on the dimension of the dataset after the subsetting
-    dset = dset.chunk({'time': round(len(dset.time) / 10),
-                       'lat': round(len(dset.lat) / 4),
-                       'lon': round(len(dset.lon) / 4)})
+    # chunk now based on the dimension of the dataset after the subsetting,
+    # the small chunks of the time-series store and the mapped arrays are kept
+    if layout != 'points' and not mmap and not served:
+        dset = dset.chunk({'time': round(len(dset.time) / 10),
+                           'lat': round(len(dset.lat) / 4),
+                           'lon': round(len(dset.lon) / 4)})
+    # Used by the cache of computations.py to read the same inputs on the whole domain
+    dset.attrs['read_dataset'] = json.dumps({'variables': list(variables),
+                                             'level': None if level is None else np.array(level).tolist(),
+                                             'engine': engine, 'freq': freq, 'layout': layout,
+                                             'mmap': mmap})
 
     return dset
 
 
+def read_points(variables, coordinates, freq=None):
+    """Datasets of the variables at the points nearest to every (lon, lat)
+    in coordinates, read from the time-series store if there is one."""
+    dset = read_dataset(variables=variables, freq=freq, layout='points')
+
+    return [dset.sel(lon=lon, lat=lat, method='nearest') for lon, lat in coordinates]
+
+
+def catalog_run(catalog):
+    """Run exported by copy_data.run, the latest one in the catalog otherwise"""
+    try:
+        return os.environ['year'] + os.environ['month'] + os.environ['day'] + os.environ['run']
+    except KeyError:
+        return max(catalog['runs'])
+
+
+def select_values(dset, dim, values, method=None):
+    """Same as dset.sel({dim: values}), but with a slice when the values are
+    evenly spaced in dim, so that the result is a view and not a copy"""
+    positions = dset.get_index(dim).get_indexer(values, method=method)
+    steps = np.unique(np.diff(positions))
+    if len(positions) and (positions >= 0).all() and len(steps) <= 1 and (steps > 0).all():
+        step = steps[0] if len(steps) else 1
+        return dset.isel({dim: slice(positions[0], positions[-1] + 1, step)})
+    return dset.sel({dim: values}, method=method)
+
+
+# Units conversions done by convert_units without pint, as (scale, offset) from
+# the units written by ingest.py
+unit_conversions = {
+    ('K', 'degC'): (1., -273.15),
+    ('Pa', 'hPa'): (0.01, 0.),
+    ('m', 'cm'): (100., 0.),
+    ('m', 'm'): (1., 0.),
+    ('m s**-1', 'kph'): (3.6, 0.),
+    ('m s-1', 'kph'): (3.6, 0.),
+    ('m/s', 'kph'): (3.6, 0.),
+}
+
+
+def convert_units(data, units):
+    """Convert the DataArray data to units in place, like
+    data.metpy.convert_units(units) does in MetPy 0.12 (newer versions
+    return the converted DataArray instead, which is written back to data).
+    With FAST_COMPUTATIONS=true the conversions in unit_conversions keep the
+    dtype (float32) and stay lazy on dask arrays, the other ones are done
+    by MetPy."""
+    conversion = unit_conversions.get((data.attrs.get('units'), units))
+    if not fast_computations or conversion is None:
+        converted = data.metpy.convert_units(units)
+        if converted is not None:
+            data.data = converted.metpy.magnitude
+            data.attrs['units'] = units
+        return
+    scale, offset = conversion
+    if scale != 1.:
+        data.data = data.data * scale
+    if offset != 0.:
+        data.data = data.data + offset
+    data.attrs['units'] = units
+
+
+def is_hourly(freq):
+    """Whether freq is one hour, the frequency of the hourly views"""
+    return bool(freq) and pd.Timedelta(freq) == pd.Timedelta(hours=1)
+
+
+def has_frequency(dset, freq):
+    """Whether the times of dset are already every freq, so that resampling
+    would not change anything"""
+    times = pd.to_datetime(dset['time'].values)
+    return len(times) == 0 or ((times[0] == times[0].floor(freq)) and
+                               (np.diff(times) == pd.Timedelta(freq)).all())
+
+
+# NetCDF3 files mapped in memory by this process, with their mapping
+mapped_files = {}
+
+
+def mapped_buffer(array):
+    """Object whose memory array is a view on, e.g. the mmap of a file"""
+    while True:
+        if isinstance(array, np.ndarray) and array.base is not None:
+            array = array.base
+        elif isinstance(array, memoryview):
+            array = array.obj
+        else:
+            return array
+
+
+def open_mapped(path):
+    """Dataset of the NetCDF3 file path whose arrays are read-only views on
+    the file mapped in memory: nothing is read until it is used, and all the
+    processes reading the same file share the pages of the page cache instead
+    of having their own copy. The data keeps the big-endian byte order of
+    the file. The variables packed as int16 (ingest.py --pack) are decoded
+    when they are used, which copies them."""
+    if path not in mapped_files:
+        nc = netcdf_file(path, mmap=True, maskandscale=False)
+        # The arrays of all the variables are views on the same mapping
+        buffers = [mapped_buffer(v.data) for v in nc.variables.values()]
+        mapped_files[path] = nc, buffers[0] if buffers else None
+    nc = mapped_files[path][0]
+
+    def attributes(attrs, fill=False):
+        return dict((k, v.decode() if isinstance(v, bytes) else v) for k, v in attrs.items()
+                    if fill or k != '_FillValue')
+    # Only the coordinates are decoded (e.g. the times), as decoding the data
+    # would convert it to the native byte order. The coordinates are small
+    # and pandas only supports the native byte order.
+    coords = xr.decode_cf(xr.Dataset(coords=dict(
+        (k, xr.Variable(v.dimensions, v.data.astype(v.data.dtype.newbyteorder('=')),
+                        attributes(v._attributes)))
+        for k, v in nc.variables.items() if k in nc.dimensions)))
+    data_vars = dict((k, xr.Variable(v.dimensions, v.data, attributes(v._attributes)))
+                     for k, v in nc.variables.items()
+                     if k not in nc.dimensions and 'scale_factor' not in v._attributes)
+    packed = xr.decode_cf(xr.Dataset(dict(
+        (k, xr.Variable(v.dimensions, v.data, attributes(v._attributes, fill=True)))
+        for k, v in nc.variables.items() if 'scale_factor' in v._attributes)))
+    data_vars.update(packed.data_vars)
+
+    return xr.Dataset(data_vars, coords=coords.coords, attrs=attributes(nc._attributes))
+
+
+def broker_dataset(variables, level=None, freq=None):
+    """Dataset and run of the variables (only the levels level) served by the
+    broker, as open_catalog would return them, or None if the broker is not
+    running or did not load them"""
+    if not os.path.exists(broker_address):
+        return None
+    with open(folder + 'catalog.json') as f:
+        run = catalog_run(json.load(f))
+    try:
+        with Client(broker_address, family='AF_UNIX') as conn:
+            conn.send({'variables': list(variables), 'run': run, 'hourly': is_hourly(freq),
+                       'level': None if level is None else np.array(level).tolist()})
+            return conn.recv()
+    except (OSError, EOFError):
+        return None
+
+
+def select_entries(ds, entries):
+    """Select in ds, which has the variables of the catalog entries, the
+    times and levels of these variables only"""
+    # A store has all the times and levels of the other variables too,
+    # only select them when needed as the selection copies the data
+    times = sorted(set(t for e in entries if e['times'] for t in e['times']))
+    if times and len(times) != ds.sizes['time']:
+        ds = select_values(ds, 'time', pd.to_datetime(times, unit='s'))
+    levels = [e['levels'] for e in entries if e['levels']]
+    if levels:
+        # open_mfdataset sorts the union of different levels
+        if any(l != levels[0] for l in levels):
+            levels = [sorted(set(sum(levels, [])))]
+        if levels[0] != ds['plev'].values.tolist():
+            ds = select_values(ds, 'plev', levels[0])
+
+    return ds
+
+
+def open_catalog(variables, layout='maps', engine='scipy', mmap=False, freq=None):
+    """Open lazily the variables of the run from the files of the catalog
+    written at ingest (see catalog.py), with the same times and levels as
+    open_mfdataset would give on the files of these variables only. The
+    time-series store is opened for layout='points' when it was written,
+    the layout opened is returned. With mmap the NETCDF3 files are memory
+    mapped by open_mapped. If freq is one hour the maps of the variables
+    with sub-hourly output are read from their hourly view. Raises
+    ValueError if the run is not in the catalog."""
+    with open(folder + 'catalog.json') as f:
+        catalog = json.load(f)
+    run = catalog_run(catalog)
+    if run not in catalog['runs']:
+        # e.g. a catalog left by an older run when the data was not downloaded
+        raise ValueError('Run %s is not in %scatalog.json, which has the runs %s'
+                         % (run, folder, ', '.join(sorted(catalog['runs'])) or 'none'))
+    available = catalog['runs'][run]['variables']
+    entries = [available[v.lower()] for v in variables if v.lower() in available]
+    if layout != 'points' or any('points' not in e for e in entries):
+        layout = 'maps'
+        if is_hourly(freq):
+            entries = [e.get('hourly', e) for e in entries]
+    files = {}
+    for e in entries:
+        files.setdefault(e['points'] if layout == 'points' else e['file'], []).append(e)
+    datasets = []
+    for path, entries in files.items():
+        if mmap and entries[0]['format'].startswith('NETCDF3'):
+            ds = open_mapped(folder + path)
+        else:
+            ds = xr.open_dataset(folder + path, chunks={},
+                                 engine=engine if entries[0]['format'].startswith('NETCDF3') else 'netcdf4')
+        ds = select_entries(ds[[e['name'] for e in entries]], entries)
+        datasets.append(preprocess(ds))
+    dset = datasets[0] if len(datasets) == 1 else xr.merge(datasets, join='outer')
+
+    return dset, pd.to_datetime(run, format='%Y%m%d%H'), layout
+
+
 def get_time_run_cum(dset):
     time = dset['time'].to_pandas()
     run = dset['run'].to_pandas()
@@ -224,8 +444,20 @@ def preprocess(ds):
         ds['VMAX_10M'].attrs['units'] = 'm/s'
     if 'plev_bnds' in ds.variables.keys():
         ds = ds.drop('plev_bnds')
+    # Keep plev also when a single level was downloaded
+    dims = [d for d in ds.sizes if ds.sizes[d] == 1 and d != 'plev']
 
-    return ds.squeeze(drop=True)
+    return ds.squeeze(dim=dims, drop=True)
+
+
+def check_levels(dset, level):
+    """Only some pressure levels are downloaded (see products.py): selecting
+    a missing level with method='nearest' would silently return another one."""
+    available = dset['plev'].values
+    missing = [int(l) for l in np.atleast_1d(level) if not np.isclose(available, l).any()]
+    if missing:
+        raise ValueError('Levels %s Pa were not downloaded (available %s), add them to products.py'
+                         % (missing, available.astype(int).tolist()))
 
 
 def print_message(message):
@@ -342,13 +574,165 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def select_plot_steps(ds):
+    """Only keep the timesteps defined in PLOT_STEPS"""
+    if plot_steps is None:
+        return ds
+    _, _, cum_hour = get_time_run_cum(ds)
+    return ds.isel(time=np.isin(cum_hour, plot_steps))
+
+
 def chunks_dataset(ds, n):
     """Same as 'chunks' but for the time dimension in
     a dataset"""
+    ds = select_plot_steps(ds)
     for i in range(0, len(ds.time), n):
         yield ds.isel(time=slice(i, i + n))
 
 
+# Shared memory blocks attached by this process, they must stay open as long
+# as the arrays which are views on them are used
+attached_blocks = {}
+# Arrays smaller than this are pickled as usual
+shared_min_bytes = 65536
+
+
+def attach_array(name, shape, dtype, offset=0, strides=None):
+    """Array which is a view on the shared memory block name"""
+    if name not in attached_blocks:
+        attached_blocks[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=attached_blocks[name].buf, offset=offset,
+                      strides=strides)
+
+
+def attach_mapped(path, offset, shape, strides, dtype):
+    """Array which is a view on the file path mapped in memory"""
+    if path not in attached_blocks:
+        with open(path, 'rb') as f:
+            attached_blocks[path] = map_file(f.fileno(), 0, access=ACCESS_READ)
+    return np.ndarray(shape, dtype=dtype, buffer=attached_blocks[path], offset=offset,
+                      strides=strides)
+
+
+def mapped_descriptor(data):
+    """attach_mapped and its arguments if data is a view on a file mapped by
+    open_mapped or attach_mapped, attach_array and its arguments if it is a
+    view on an attached shared memory block, None otherwise"""
+    buffers = [(attach_mapped, path, mapping) for path, (_, mapping) in mapped_files.items()
+               if isinstance(mapping, map_file)]
+    for key, block in attached_blocks.items():
+        if isinstance(block, shared_memory.SharedMemory):
+            buffers.append((attach_array, block.name, block.buf))
+        else:
+            buffers.append((attach_mapped, key, block))
+    for function, key, buf in buffers:
+        buf = np.frombuffer(buf, dtype=np.uint8)
+        if np.may_share_memory(data, buf):
+            offset = data.__array_interface__['data'][0] - buf.__array_interface__['data'][0]
+            if function is attach_array:
+                return function, (key, data.shape, data.dtype, offset, data.strides)
+            return function, (key, offset, data.shape, data.strides, data.dtype)
+    return None
+
+
+def attach_dataset(variables, coords, attrs, indexers):
+    """Rebuild in a process the dataset described by SharedDataset"""
+    def variable(dims, data, var_attrs):
+        if isinstance(data, tuple):
+            function, args = data
+            data = function(*args)
+        return xr.Variable(dims, data, var_attrs)
+    dset = xr.Dataset(dict((k, variable(*v)) for k, v in variables.items()),
+                      coords=dict((k, variable(*v)) for k, v in coords.items()),
+                      attrs=attrs)
+    return dset.isel(indexers)
+
+
+class SharedArray(object):
+    """Array copied into shared memory, which is pickled as the name of the
+    block and unpickled as a view on it"""
+
+    def __init__(self, shared, array):
+        self.descriptor = shared.share(array)
+
+    def __reduce__(self):
+        return attach_array, self.descriptor
+
+
+class SharedDatasetChunk(object):
+    """Subset of a SharedDataset, unpickled as an xarray Dataset"""
+
+    def __init__(self, shared, indexers):
+        self.shared = shared
+        self.indexers = indexers
+
+    def __reduce__(self):
+        return attach_dataset, (self.shared.variables, self.shared.coords,
+                                self.shared.attrs, self.indexers)
+
+
+class SharedDataset(object):
+    """Loaded dataset whose arrays are copied once into shared memory.
+    Sending a chunk of it to the processes of a Pool only pickles the names
+    of the blocks, and every process rebuilds the dataset as views on the
+    blocks instead of receiving (and keeping) its own copy. The arrays which
+    are views on a memory mapped file (see open_mapped) are not copied, the
+    processes map the same file. The blocks are removed by close, after all
+    the processes are done. With copy=False the other arrays are pickled
+    instead of being copied into shared memory."""
+
+    def __init__(self, dset, copy=True):
+        self.blocks = []
+        self.copy = copy
+        self.variables = dict((k, self.describe(v)) for k, v in dset.data_vars.items())
+        self.coords = dict((k, self.describe(v)) for k, v in dset.coords.items())
+        self.attrs = dset.attrs
+        self.sizes = dict(dset.sizes)
+
+    def share(self, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return block.name, array.shape, array.dtype
+
+    def describe(self, var):
+        data = var.values
+        if data.dtype.kind in 'biufcmM' and data.nbytes >= shared_min_bytes:
+            mapped = mapped_descriptor(data)
+            if mapped:
+                data = mapped
+            elif self.copy:
+                data = (attach_array, self.share(data))
+        return var.dims, data, var.attrs
+
+    def chunks(self, n):
+        """Chunks of n time steps, as chunks_dataset"""
+        for i in range(0, self.sizes['time'], n):
+            yield SharedDatasetChunk(self, {'time': slice(i, i + n)})
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def plot_parallel(plot_files, dset, **args):
+    """Plot the time steps of dset (only the ones in PLOT_STEPS) in chunks
+    of chunks_size steps in parallel processes. The dataset and the large
+    arrays in args (e.g. the coordinates) are passed to the processes in
+    shared memory (see SharedDataset)."""
+    shared = SharedDataset(select_plot_steps(dset).load())
+    try:
+        args = dict((k, SharedArray(shared, v) if isinstance(v, np.ndarray) and
+                     v.nbytes >= shared_min_bytes else v) for k, v in args.items())
+        with Pool(processes) as p:
+            p.map(partial(plot_files, **args), shared.chunks(chunks_size))
+    finally:
+        shared.close()
+
+
 # Annotation run, models 
 def annotation_run(ax, time, loc='upper right',fontsize=8):
     """Put annotation of the run obtaining it from the
@@ -0,0 +1,212 @@
+"""Declaration of the inputs of the products made by the plotting scripts, and
+planner which derives from it the variables and pressure levels to download.
+copy_data.run only lists the products to make, e.g.
+
+    python download_dwd.py --products plot_cape.py plot_meteogram.py
+
+downloads cape_ml, cin_ml, HSURF, u and v only at 850 hPa for plot_cape.py
+and so on. Use
+
+    python products.py plot_cape.py plot_meteogram.py
+
+to print the plan, and
+
+    python products.py --check
+
+to verify that the declarations match the read_dataset calls of the scripts
+in plotting/. The declarations must be updated every time the inputs of a
+script change."""
+import os
+import ast
+import sys
+import argparse
+
+home_folder = os.getenv('HOME_FOLDER', os.path.dirname(os.path.abspath(__file__)))
+
+# All the projections defined in plotting/projections.py
+projections = ['de', 'it', 'nord']
+
+# Variables which are only available on pressure levels (hPa)
+variables_3d = ['clc', 'fi', 'omega', 'relhum', 't', 'u', 'v', 'w']
+pressure_levels = [200, 250, 300, 400, 500, 600, 700, 850, 950, 975, 1000]
+
+# Variables which do not depend on time
+variables_invariant = ['hsurf']
+
+# Inputs of every product. levels are the pressure levels (hPa) of the 3d
+# variables, either the same for all of them or a dictionary with the levels
+# of every variable, None means all of them. projections are the ones on which
+# the product is plotted, products without projections (meteograms) are
+# not maps. lookahead is the number of following steps needed to compute
+# a frame, e.g. rates computed with centred differences.
+products = {
+    'plot_cape.py': {'variables': ['cape_ml', 'cin_ml', 'u', 'v'], 'levels': [850]},
+    'plot_gph_500_mslp.py': {'variables': ['fi', 'pmsl'], 'levels': [500]},
+    'plot_gph_t_500.py': {'variables': ['t', 'fi'], 'levels': [500]},
+    'plot_gph_t_850.py': {'variables': ['t', 'fi'], 'levels': {'t': [850], 'fi': [500]}},
+    'plot_gph_thetae_850.py': {'variables': ['t', 'relhum', 'pmsl'], 'levels': [850]},
+    'plot_hsnow.py': {'variables': ['h_snow', 'snowlmt']},
+    # The vertical profiles need all the levels, which are only downloaded
+    # when the meteograms are in the list of products
+    'plot_meteogram.py': {'variables': ['t_2m', 'td_2m', 't', 'vmax_10m', 'pmsl', 'hsurf',
+                                        'ww', 'rain_gsp', 'snow_gsp', 'relhum', 'u', 'v'],
+                          'levels': None, 'projections': []},
+    'plot_pres_t2m_winds10m.py': {'variables': ['u_10m', 'v_10m', 't_2m', 'pmsl']},
+    'plot_rain_acc.py': {'variables': ['tot_prec', 'pmsl']},
+    'plot_rain_acc_24.py': {'variables': ['tot_prec']},
+    'plot_rain_clouds.py': {'variables': ['rain_gsp', 'snow_gsp', 'pmsl', 'clcl', 'clch'],
+                            'lookahead': 1},
+    'plot_reflectivity.py': {'variables': ['dbz_cmax']},
+    'plot_relhum.py': {'variables': ['relhum', 'fi'], 'levels': [950, 850, 700, 500]},
+    'plot_sat.py': {'variables': ['rain_gsp', 'snow_gsp', 'pmsl', 'synmsg_bt_cl_ir10.8']},
+    'plot_t.py': {'variables': ['t', 'fi'], 'levels': [950, 850, 700, 500]},
+    'plot_t850_pres.py': {'variables': ['t', 'pmsl'], 'levels': [850]},
+    'plot_tmax.py': {'variables': ['tmax_2m']},
+    'plot_tmin.py': {'variables': ['tmin_2m']},
+    'plot_winds10m.py': {'variables': ['vmax_10m', 'pmsl', 'u_10m', 'v_10m']},
+    'plot_winter.py': {'variables': ['rain_gsp', 'h_snow', 'snowlmt']},
+}
+
+
+def get_product(name):
+    """Declaration of a product with the defaults filled in"""
+    if name not in products:
+        raise ValueError('Product %s is not declared in products.py' % name)
+    return dict({'levels': [], 'projections': projections, 'lookahead': 0},
+                **products[name])
+
+
+def product_levels(product, var):
+    """Pressure levels of var needed by product"""
+    if isinstance(product['levels'], dict):
+        return product['levels'].get(var, [])
+    return product['levels']
+
+
+def parse_levels(items):
+    """Parse the per-variable levels given on the command line as
+    var=level,level or var=all"""
+    levels = {}
+    for item in items:
+        var, _, values = item.partition('=')
+        if not values:
+            raise ValueError('Levels of %s not given, use %s=500,850 or %s=all' % (var, var, var))
+        if values == 'all':
+            levels[var] = None
+        else:
+            levels[var] = sorted(int(l) for l in values.split(','))
+    return levels
+
+
+def variable_kind(var):
+    var = var.lower()
+    if var in variables_3d:
+        return '3d'
+    if var in variables_invariant:
+        return 'invariant'
+    return '2d'
+
+
+def plan_fetch(names=None, projections=None):
+    """Minimal set of variables needed to make the products in names (all
+    of them by default). If projections is given, maps which are not plotted
+    on any of these projections are left out. Returns a dictionary with the
+    2d variables, the 3d variables mapped to the sorted list of their levels
+    (None for all the levels) and the time-invariant variables."""
+    if names is None:
+        names = list(products)
+    plan = {'2d': [], '3d': {}, 'invariant': []}
+    for name in names:
+        product = get_product(name)
+        if projections is not None and product['projections'] and \
+                not set(product['projections']).intersection(projections):
+            continue
+        for var in product['variables']:
+            kind = variable_kind(var)
+            if kind == '3d':
+                levels = plan['3d'].setdefault(var, [])
+                needed = product_levels(product, var)
+                if levels is None or needed is None:
+                    plan['3d'][var] = None
+                else:
+                    plan['3d'][var] = sorted(set(levels + needed))
+            elif var not in plan[kind]:
+                plan[kind].append(var)
+    return plan
+
+
+def read_dataset_inputs(path):
+    """Variables and levels requested by the read_dataset (and read_points)
+    calls of a script, without importing it."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    variables, levels = [], []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and getattr(node.func, 'id', None) in ('read_dataset', 'read_points')):
+            continue
+        for keyword in node.keywords:
+            try:
+                value = ast.literal_eval(keyword.value)
+            except ValueError:
+                # e.g. level=[l * 100 for l in levels], cannot be checked
+                continue
+            if keyword.arg == 'variables':
+                variables += [v.lower() for v in value if v.lower() not in variables]
+            elif keyword.arg == 'level':
+                value = value if isinstance(value, list) else [value]
+                levels += [int(l / 100) for l in value]
+    return variables, levels
+
+
+def check_declarations(folder=None):
+    """Compare the declarations with the scripts in folder. Returns a list of
+    messages describing the differences."""
+    if folder is None:
+        folder = os.path.join(home_folder, 'plotting')
+    errors = []
+    scripts = sorted(f for f in os.listdir(folder)
+                     if f.startswith('plot_') and f.endswith('.py'))
+    for script in scripts:
+        if script not in products:
+            errors.append('%s is not declared' % script)
+            continue
+        variables, levels = read_dataset_inputs(os.path.join(folder, script))
+        declared = get_product(script)
+        if set(variables) != set(declared['variables']):
+            errors.append('%s reads %s but declares %s' %
+                          (script, sorted(variables), sorted(declared['variables'])))
+        # Every level read must be declared for at least one variable, as
+        # read_dataset refuses to select a level which was not downloaded
+        declared_levels = [product_levels(declared, var) for var in declared['variables']
+                           if variable_kind(var) == '3d']
+        if levels and None not in declared_levels and \
+                set(levels) != set(sum(declared_levels, [])):
+            errors.append('%s reads levels %s but declares %s' %
+                          (script, sorted(levels), sorted(set(sum(declared_levels, [])))))
+    for name in products:
+        if name not in scripts:
+            errors.append('%s is declared but does not exist' % name)
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('products', help='Products to make, all of them if not given',
+                        nargs='*')
+    parser.add_argument('--projections', help='Only consider maps plotted on these projections',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('--check', help='Check the declarations against the plotting scripts',
+                        required=False, action='store_true')
+    args = parser.parse_args()
+
+    if args.check:
+        errors = check_declarations()
+        for error in errors:
+            print(error)
+        sys.exit(1 if errors else 0)
+
+    plan = plan_fetch(args.products or None, args.projections)
+    print('2d: %s' % ' '.join(plan['2d']))
+    print('3d: %s' % ' '.join('%s(%s)' % (var, 'all' if levels is None else ','.join(map(str, levels)))
+                              for var, levels in sorted(plan['3d'].items())))
+    print('invariant: %s' % ' '.join(plan['invariant']))
@@ -0,0 +1,241 @@
+"""Consolidate the per-variable files written by ingest.py into a single
+compressed NetCDF4 (HDF5) store for the whole run, and replace them with the
+store in the catalog of the runs (see catalog.py). Every field is stored as chunks
+of one time (and one level) on the full lat/lon grid, so that a map frame is
+a single contiguous read. read_dataset in plotting/utils.py opens the store
+lazily when it exists. Called from copy_data.run after ingest.py as
+
+    python store.py --remove
+
+With --points the variables are also copied into a time-series store
+(icon-d2_<run>_points.nc) chunked as all the times of small tiles of points,
+so that the meteograms and point queries read a few kB per variable.
+
+With --format NETCDF3_64BIT_OFFSET the store is not compressed and every
+variable is contiguous (a map frame still is a single contiguous read), so
+that read_dataset(mmap=True) can map it in memory without copying it.
+
+The hourly views of the variables with sub-hourly output written by ingest.py
+are not copied, their files are kept and stay in the catalog.
+
+Variables are put on the union of the times and levels of all the variables,
+the chunks which are never written (e.g. a level which was not downloaded
+for that variable) take no space on disk."""
+import os
+import sys
+import argparse
+import numpy as np
+import netCDF4
+from catalog import load_catalog, update_catalog
+from download_dwd import get_run_from_env
+from products import variable_kind
+
+
+def store_file(run, folder='.'):
+    return os.path.join(folder, 'icon-d2_%s_store.nc' % run)
+
+
+def points_file(run, folder='.'):
+    return os.path.join(folder, 'icon-d2_%s_points.nc' % run)
+
+
+def find_variables(run, folder='.'):
+    """Map the variables of run which are in a merged file to their catalog entry"""
+    variables = load_catalog(folder)['runs'].get(run, {'variables': {}})['variables']
+    store = os.path.basename(store_file(run, folder))
+    return dict((var, entry) for var, entry in sorted(variables.items()) if entry['file'] != store)
+
+
+def data_variable(ds):
+    """Name of the (only) data variable of a merged file"""
+    return [name for name in ds.variables if name not in ('time', 'lat', 'lon', 'plev')][0]
+
+
+def create_store(path, run, sources, times, levels, fmt='NETCDF4'):
+    """Create the file of a store with the coordinates of all the sources"""
+    first = list(sources.values())[0]
+    nc = netCDF4.Dataset(path, 'w', format=fmt)
+    nc.setncattr('run', run)
+    for name, values in (('time', times), ('lat', first['lat'][:]), ('lon', first['lon'][:]),
+                         ('plev', levels)):
+        if name == 'plev' and not levels:
+            continue
+        nc.createDimension(name, len(values))
+        coord = nc.createVariable(name, 'f8', (name,))
+        src = [ds[name] for ds in sources.values() if name in ds.variables][0]
+        coord.setncatts(dict((a, src.getncattr(a)) for a in src.ncattrs() if a != '_FillValue'))
+        coord[:] = values
+    return nc
+
+
+def variable_dims(var, src):
+    if variable_kind(var) == 'invariant':
+        return ('lat', 'lon')
+    if 'plev' in src.dimensions:
+        return ('time', 'plev', 'lat', 'lon')
+    return ('time', 'lat', 'lon')
+
+
+def copy_frames(src, dst, dims, time_index, level_index):
+    """Copy one frame at a time, so that memory use doesn't depend on the
+    variable size"""
+    if 'time' not in dims:
+        dst[:, :] = src[0, :, :]
+        return
+    levels = src.group()['plev'][:].tolist() if 'plev' in dims else None
+    for i, t in enumerate(src.group()['time'][:].tolist()):
+        if levels is None:
+            dst[time_index[t], :, :] = src[i, :, :]
+        else:
+            for j, l in enumerate(levels):
+                dst[time_index[t], level_index[l], :, :] = src[i, j, :, :]
+
+
+def copy_bands(src, dst, dims, time_index, level_index, rows):
+    """Copy bands of rows latitudes with all their times, so that every
+    chunk of the time-series layout is written whole"""
+    if 'time' not in dims:
+        dst[:, :] = src[0, :, :]
+        return
+    times = [time_index[t] for t in src.group()['time'][:].tolist()]
+    levels = src.group()['plev'][:].tolist() if 'plev' in dims else None
+    for start in range(0, src.shape[-2], rows):
+        band = slice(start, start + rows)
+        if levels is None:
+            dst[times, band, :] = src[:, band, :]
+        else:
+            for j, l in enumerate(levels):
+                dst[times, level_index[l], band, :] = src[:, j, band, :]
+
+
+def build_store(run, folder='.', variables=None, complevel=1, remove=False,
+                points=False, tile=16, fmt='NETCDF4'):
+    """Copy the merged files of the variables (all of them by default) into
+    the store of run and register it in the catalog. If points is True the
+    variables are also copied into the time-series store, chunked as all the
+    times of tile x tile points. With a NETCDF3 fmt the store is not
+    compressed and every variable is contiguous, so that it can be memory
+    mapped by read_dataset; the time-series store is always NETCDF4.
+    Returns the catalog entries of the variables."""
+    merged = find_variables(run, folder)
+    files = dict((var, os.path.join(folder, entry['file'])) for var, entry in merged.items())
+    if variables is not None:
+        files = dict((var.lower(), files[var.lower()]) for var in variables
+                     if var.lower() in files)
+    if not files:
+        raise ValueError('No merged files found for run %s in %s' % (run, folder))
+    sources = dict((var, netCDF4.Dataset(path)) for var, path in files.items())
+    layouts = [(store_file(run, folder), 'maps')]
+    if points:
+        layouts.append((points_file(run, folder), 'points'))
+    try:
+        first = list(sources.values())[0]
+        lat, lon = first['lat'][:], first['lon'][:]
+        for var, ds in sources.items():
+            if ds['lat'].shape != lat.shape or ds['lon'].shape != lon.shape or \
+                    not np.allclose(ds['lat'][:], lat) or not np.allclose(ds['lon'][:], lon):
+                raise ValueError('%s is not on the same grid as the other variables' % var)
+        times = sorted(set(t for var, ds in sources.items() if variable_kind(var) != 'invariant'
+                           for t in ds['time'][:].tolist()))
+        levels = sorted(set(l for ds in sources.values() if 'plev' in ds.variables
+                            for l in ds['plev'][:].tolist()), reverse=True)
+        time_index = dict((t, i) for i, t in enumerate(times))
+        level_index = dict((l, i) for i, l in enumerate(levels))
+
+        bbox = [float(lon.min()), float(lon.max()), float(lat.min()), float(lat.max())]
+        entries = {}
+        for path, layout in layouts:
+            layout_fmt = fmt if layout == 'maps' else 'NETCDF4'
+            nc = create_store(path + '.tmp', run, sources, times, levels, layout_fmt)
+            for var, ds in sources.items():
+                name = data_variable(ds)
+                src = ds[name]
+                dims = variable_dims(var, src)
+                if layout == 'maps':
+                    sizes = {'time': 1, 'plev': 1, 'lat': len(lat), 'lon': len(lon)}
+                else:
+                    sizes = {'time': len(times), 'plev': 1, 'lat': tile, 'lon': tile}
+                chunks = tuple(min(sizes[d], len(nc.dimensions[d])) for d in dims)
+                # The variables packed as int16 at ingest are copied packed
+                packed = 'scale_factor' in src.ncattrs()
+                dtype = src.dtype if packed else 'f4'
+                fill_value = src.getncattr('_FillValue') if packed else np.float32(np.nan)
+                if layout_fmt == 'NETCDF4':
+                    dst = nc.createVariable(name, dtype, dims, zlib=True, complevel=complevel,
+                                            shuffle=True, chunksizes=chunks,
+                                            fill_value=fill_value)
+                else:
+                    dst = nc.createVariable(name, dtype, dims, fill_value=fill_value)
+                dst.setncatts(dict((a, src.getncattr(a)) for a in src.ncattrs()
+                                   if a != '_FillValue'))
+                if packed:
+                    src.set_auto_maskandscale(False)
+                    dst.set_auto_maskandscale(False)
+                if layout == 'maps':
+                    copy_frames(src, dst, dims, time_index, level_index)
+                else:
+                    # The chunk cache must hold a whole band of chunks
+                    rows = tile * 8
+                    dst.set_var_chunk_cache(size=len(times) * (rows + tile) * (len(lon) + tile) * 4)
+                    copy_bands(src, dst, dims, time_index, level_index, rows)
+                entries[var] = {
+                    'file': os.path.basename(store_file(run, folder)),
+                    'name': name,
+                    'format': fmt,
+                    'levels': ds['plev'][:].tolist() if 'plev' in dims else None,
+                    'times': ds['time'][:].tolist() if 'time' in dims else None,
+                    'bbox': bbox,
+                }
+                if points:
+                    entries[var]['points'] = os.path.basename(points_file(run, folder))
+                # The hourly views written at ingest are kept as they are
+                if 'hourly' in merged[var]:
+                    entries[var]['hourly'] = merged[var]['hourly']
+            nc.close()
+    except Exception:
+        for path, _ in layouts:
+            if os.path.isfile(path + '.tmp'):
+                os.remove(path + '.tmp')
+        raise
+    finally:
+        for ds in sources.values():
+            ds.close()
+    for path, _ in layouts:
+        os.replace(path + '.tmp', path)
+    update_catalog(folder, run, entries)
+    if remove:
+        for path in files.values():
+            os.remove(path)
+    return entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run to consolidate (YYYYMMDDHH), defaults to the one exported by copy_data.run',
+                        required=False, default=get_run_from_env())
+    parser.add_argument('-v', '--variables', help='Variables to put in the store, all the merged files by default',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('-f', '--folder', help='Folder with the merged files where the store is written',
+                        required=False, default='.')
+    parser.add_argument('-c', '--complevel', help='zlib compression level',
+                        required=False, default=1, type=int)
+    parser.add_argument('--format', help='Format of the store, NETCDF3_64BIT_OFFSET is not compressed but can be memory mapped',
+                        required=False, default='NETCDF4', choices=['NETCDF4', 'NETCDF3_64BIT_OFFSET'])
+    parser.add_argument('--remove', help='Remove the merged files once they are in the store',
+                        required=False, action='store_true')
+    parser.add_argument('--points', help='Also write the time-series store used by the meteograms and point queries',
+                        required=False, action='store_true')
+    parser.add_argument('-t', '--tile', help='Number of points in latitude and longitude of the chunks of the time-series store',
+                        required=False, default=16, type=int)
+    args = parser.parse_args()
+
+    if args.run is None:
+        parser.error('run not given and not found in the environment')
+
+    try:
+        entries = build_store(args.run, args.folder, args.variables, args.complevel,
+                              args.remove, args.points, args.tile, args.format)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print('Written %s with %d variables' % (store_file(args.run, args.folder), len(entries)))
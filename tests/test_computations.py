@@ -0,0 +1,69 @@
+"""Compare the rates of compute_rate in plotting/computations.py, which feeds
+the frames one at a time through step_rates, with differentiate on the
+dataset returned by read_dataset for a run ingested by ingest.py. The run
+has uneven time steps, so that the weights of the centred differences
+matter."""
+import os
+import sys
+import numpy as np
+import pytest
+
+home_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+os.environ.setdefault('MAPBOX_KEY', '')
+sys.path.insert(0, home_folder)
+sys.path.insert(0, os.path.join(home_folder, 'plotting'))
+sys.path.insert(0, os.path.join(home_folder, 'benchmarks'))
+from ingest import ingest_variable
+from dwd_mirror import make_grib
+import utils
+import computations
+
+run = '2021010100'
+steps = [0, 1, 2, 3, 5, 6, 9, 10]
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    for var in ('rain_gsp', 'snow_gsp'):
+        files = []
+        for step in steps:
+            path = str(tmp_path / ('icon-d2_germany_regular-lat-lon_single-level_%s_%03d_2d_%s.grib2'
+                                   % (run, step, var)))
+            with open(path, 'wb') as f:
+                f.write(make_grib(run, step, seed=len(var)))
+            files.append(path)
+        ingest_variable(var, run, files, str(tmp_path))
+    for name in ('year', 'month', 'day', 'run'):
+        monkeypatch.delenv(name, raising=False)
+    folder = str(tmp_path) + '/'
+    monkeypatch.setattr(utils, 'folder', folder)
+    monkeypatch.setattr(computations, 'folder', folder)
+    return folder
+
+
+def expected_rates(dset, name):
+    return dset[name].load().differentiate(coord='time', datetime_unit='h').values
+
+
+def test_compute_rate_same_as_differentiate(data_folder, monkeypatch):
+    monkeypatch.setattr(computations, 'derived_cache', False)
+    dset = utils.read_dataset(['RAIN_GSP', 'SNOW_GSP'], freq=None)
+    assert dset.sizes['time'] == len(steps)
+    rates = computations.compute_rate(dset)
+    assert np.allclose(rates['rain_rate'].values, expected_rates(dset, 'RAIN_GSP'), atol=1e-4)
+    assert np.allclose(rates['snow_rate'].values, expected_rates(dset, 'SNOW_GSP'), atol=1e-4)
+
+
+def test_compute_rate_plot_steps(data_folder, monkeypatch):
+    monkeypatch.setattr(computations, 'derived_cache', True)
+    dset = utils.read_dataset(['RAIN_GSP', 'SNOW_GSP'], freq=None)
+    plotted = [0, 5, 6, 10]
+    rates = computations.compute_rate(dset, steps=plotted)['rain_rate'].values
+    # Computed on the whole domain and written to the cache of the run
+    assert any(name.startswith('derived_%s_compute_rate_' % run) for name in os.listdir(data_folder))
+    expected = expected_rates(dset, 'RAIN_GSP')
+    for i, step in enumerate(steps):
+        if step in plotted:
+            assert np.allclose(rates[i], expected[i], atol=1e-4)
+        else:
+            assert np.isnan(rates[i]).all()
@@ -0,0 +1,110 @@
+"""Run the prober of get_last_run.py against a local stand-in of the DWD
+opendata server, which serves the directory listings of the icon-d2-eps
+runs in the same format as the real server (see benchmarks/dwd_mirror.py).
+The latest run which has started is only partly published, the previous
+ones are complete."""
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import listing_cache
+from get_last_run import get_most_recent_run
+
+model_url = 'icon-d2-eps/grib'
+runs = ['00', '03', '06', '09', '12', '15', '18', '21']
+
+
+def published_runs():
+    """Date and hour of the run on the server for every run hour, the most
+    recent one which has started, as get_most_recent_run selects them"""
+    now = datetime.utcnow()
+    today = now.strftime('%Y%m%d')
+    yesterday = (now - timedelta(days=1)).strftime('%Y%m%d')
+    return dict((run, today if today + run <= now.strftime('%Y%m%d%H') else yesterday)
+                for run in runs)
+
+
+def listing_files(date, run, var, steps):
+    if var == 't':
+        return ['icon-d2-eps_germany_icosahedral_pressure-level_%s%s_%03d_850_t.grib2.bz2'
+                % (date, run, step) for step in steps]
+    return ['icon-d2-eps_germany_icosahedral_single-level_%s%s_%03d_2d_%s.grib2.bz2'
+            % (date, run, step, var) for step in steps]
+
+
+class ListingHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        listings = self.server.listings
+        if len(parts) != 4 or '/'.join(parts[:2]) != model_url or (parts[2], parts[3]) not in listings:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = '<html>\r\n<head><title>Index of %s</title></head>\r\n<body>\r\n<pre><a href="../">../</a>\r\n' \
+               % self.path
+        body += ''.join('<a href="%s">%s</a> 01-Jan-2021 00:00 1000\r\n' % (name, name)
+                        for name in listings[(parts[2], parts[3])])
+        body = (body + '</pre><hr></body>\r\n</html>\r\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(listing_cache, 'cache_folder', str(tmp_path))
+    published = published_runs()
+    latest = max(date + run for run, date in published.items())
+    listings = {}
+    for run, date in published.items():
+        steps = range(46 if run == '03' else 28)
+        if date + run == latest:
+            steps = range(10)
+        for var in ('t_2m', 't'):
+            listings[(run, var)] = listing_files(date, run, var, steps)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ListingHandler)
+    httpd.listings = listings
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1], latest
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_search_newest_same_as_all(server):
+    base_url, latest = server
+    kwargs = dict(vars_2d=['t_2m'], vars_3d=['t'], levels_3d=['850'], workers=4,
+                  base_url=base_url, model_url=model_url)
+    table_all, run_all = get_most_recent_run(search='all', **kwargs)
+    table_newest, run_newest = get_most_recent_run(search='newest', **kwargs)
+
+    complete = sorted(date + run for run, date in published_runs().items()
+                      if date + run != latest)
+    assert run_all == run_newest == complete[-1]
+    # The runs checked by newest have the same status as when checking all of them
+    assert set(table_newest['run']) == {latest, complete[-1]}
+    merged = table_newest.merge(table_all, on=['run', 'variable'], suffixes=('', '_all'))
+    assert len(merged) == len(table_newest)
+    for column in ('status', 'avail_tsteps', 'missing_tsteps'):
+        assert (merged[column] == merged[column + '_all']).all()
+    assert (table_newest.loc[table_newest['run'] == latest, 'avail_tsteps'] == 10).all()
+
+
+def test_started_selects_latest(server):
+    base_url, latest = server
+    kwargs = dict(vars_2d=['t_2m'], vars_3d=['t'], levels_3d=['850'], workers=4,
+                  base_url=base_url, model_url=model_url, started=True)
+    _, run_all = get_most_recent_run(search='all', **kwargs)
+    _, run_newest = get_most_recent_run(search='newest', **kwargs)
+    assert run_all == run_newest == latest
@@ -0,0 +1,73 @@
+"""Decode GRIB messages on the ICON-D2 regular lat-lon grid with ingest.py.
+The messages are written by make_grib of benchmarks/dwd_mirror.py with the
+grid of the files published by DWD: 1215 x 746 points every 0.02 degrees
+from (-3.94, 43.18), the longitudes being written in 0..360 as in the real
+files (356.06 to 20.34)."""
+import os
+import sys
+import numpy as np
+import eccodes
+
+home_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, home_folder)
+sys.path.insert(0, os.path.join(home_folder, 'benchmarks'))
+from ingest import decode_bytes, crop_message, get_crop_bbox, split_messages, ingest_variable
+from dwd_mirror import make_grib
+
+
+def icon_d2_message(level=None):
+    return make_grib('2021010100', 3, level=level, grid=(1215, 746), resolution=0.02)
+
+
+def test_grid_longitudes():
+    data = icon_d2_message()
+    gid = eccodes.codes_new_from_message(data)
+    try:
+        assert eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees') > 180
+    finally:
+        eccodes.codes_release(gid)
+    message = decode_bytes(data)[0]
+    lon, lat = message['lon'], message['lat']
+    assert len(lon) == 1215 and len(lat) == 746
+    assert lon[0] < 0 < lon[-1]
+    assert np.isclose(lon[0], -3.94) and np.isclose(lon[-1], 20.34)
+    assert np.allclose(np.diff(lon), 0.02)
+    assert np.isclose(lat[0], 43.18) and np.allclose(np.diff(lat), 0.02)
+    assert message['values'].shape == (746, 1215)
+    assert message['time'].strftime('%Y%m%d%H') == '2021010103'
+
+
+def test_crop_projections():
+    message = decode_bytes(icon_d2_message(level=500))[0]
+    assert message['level'] == 50000
+    bbox = get_crop_bbox(margin=0.5)
+    cropped = crop_message(message, bbox)
+    lon, lat = cropped['lon'], cropped['lat']
+    assert lon[0] >= bbox[0] and lon[-1] <= bbox[2] and lat[0] >= bbox[1] and lat[-1] <= bbox[3]
+    # The box is inside the ICON-D2 domain, so the crop is smaller than it
+    assert 0 < len(lon) < 1215 and 0 < len(lat) < 746
+    assert cropped['values'].shape == (len(lat), len(lon))
+    ilon = np.searchsorted(message['lon'], lon[0])
+    ilat = np.searchsorted(message['lat'], lat[0])
+    assert np.array_equal(cropped['values'], message['values'][ilat:ilat + len(lat), ilon:ilon + len(lon)])
+
+
+def test_split_messages():
+    first, second = icon_d2_message(), icon_d2_message(level=850)
+    assert split_messages(first + second) == [first, second]
+
+
+def test_clipped_reported_once(tmp_path, capsys):
+    run = '2021010100'
+    files = []
+    for step in range(3):
+        path = str(tmp_path / ('icon-d2_germany_regular-lat-lon_single-level_%s_%03d_2d_clct.grib2'
+                               % (run, step)))
+        with open(path, 'wb') as f:
+            f.write(make_grib(run, step))
+        files.append(path)
+    # The synthetic fields are around 280, out of the 0..100 of the cloud cover
+    ingest_variable('clct', run, files, str(tmp_path), pack=True)
+    ingest_variable('t_2m', run, files, str(tmp_path), pack=True)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ['clct: %d values out of the range of the packing clipped' % (3 * 122 * 75)]
@@ -0,0 +1,233 @@
+"""Process a run progressively while DWD is publishing it. Instead of waiting
+for all the timesteps to be available we poll the listings of every variable,
+download the steps which were published since the last poll, merge them and
+launch the plotting scripts only on the frames whose inputs are complete, so
+that the first forecast hours are online long before the last step exists.
+Called from copy_data.run (from MODEL_DATA_FOLDER, where the plotting scripts
+were copied) as
+
+    python watch_run.py --products plot_cape.py plot_gph_t_500.py
+
+The plotting scripts are told which frames to render through PLOT_STEPS
+(see utils.py)."""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from download_dwd import Manifest, ConcurrencyController, list_files, download_files, \
+    file_step, get_run_from_env
+from ingest import OutputWriter, ingest_variable, iter_messages, get_crop_bbox, \
+    get_city_coordinates
+from listing_cache import get_session
+from products import products, get_product, plan_fetch, parse_levels
+
+
+def print_message(message):
+    print('%s watch_run.py : %s' % (time.strftime('%H:%M:%S'), message))
+    sys.stdout.flush()
+
+
+def last_complete_step(manifest, var, run):
+    """Last step k such that all the steps 0..k of var are valid on disk.
+    For 3d variables a step is complete only when all its levels are there."""
+    counts = {}
+    for name in manifest.variables.get(var, []):
+        if manifest.is_valid(name, checksum=False):
+            step = file_step(name, run)
+            counts[step] = counts.get(step, 0) + 1
+    if not counts:
+        return -1
+    n_levels = max(counts.values())
+    step = -1
+    while counts.get(step + 1) == n_levels:
+        step += 1
+    return step
+
+
+def merge_variable(writer, run, first_step, last_step, manifest, folder='.'):
+    """Append the steps first_step..last_step of the variable of writer to its
+    merged file, which stays open between the polls, and publish them. The
+    steps already merged are never rewritten, so the renders running on them
+    are not disturbed."""
+    files_by_step = {}
+    for name in manifest.variables[writer.var]:
+        step = file_step(name, run)
+        if first_step <= step <= last_step:
+            files_by_step.setdefault(step, []).append(os.path.join(folder, name))
+    for step in sorted(files_by_step):
+        writer.write_step([message for path in files_by_step[step]
+                           for message in iter_messages(path)])
+    writer.sync()
+
+
+def render(script, projection, first_step, last_step, folder='.'):
+    """Launch a plotting script only on the frames first_step..last_step"""
+    env = dict(os.environ, PLOT_STEPS='%d-%d' % (first_step, last_step))
+    return subprocess.call([sys.executable, script, projection], cwd=folder, env=env)
+
+
+def watch_run(run, vars_2d=[], vars_3d=[], folder='.', last_step=48, interval=120,
+              timeout=6 * 3600, min_new_steps=6, workers=16, render_workers=4, bbox=None,
+              levels={}, scripts=None, fmt='NETCDF3_64BIT_OFFSET', pack=False):
+    """Poll the server until all the steps of the variables are downloaded and all
+    the products are rendered. A product is rendered when at least min_new_steps
+    new frames are ready, or when its last frames are ready. levels maps 3d
+    variables to the pressure levels to download (all of them by default).
+    Only the maps in scripts are rendered, by default all those for which
+    all the variables are downloaded. The merged files are packed as int16
+    if pack, as ingest.py does. They are NETCDF3 files, which the renders can
+    read while the next steps are appended, and are converted to fmt once
+    all the renders are done."""
+    start = time.time()
+    session = get_session(pool_size=workers)
+    manifest = Manifest(run, folder)
+    # Shared between the polls so that what was learned about the server is kept
+    controller = ConcurrencyController(maximum=workers)
+    kinds = dict([(var, '2d') for var in vars_2d] + [(var, '3d') for var in vars_3d])
+    if scripts is None:
+        scripts = [p for p in products if set(products[p]['variables']).issubset(kinds)]
+    # Meteograms are not maps, they are made at the end by copy_data.run
+    watched = dict((p, get_product(p)) for p in scripts if get_product(p)['projections'])
+    ready = dict((var, -1) for var in kinds)
+    merged = dict((var, -1) for var in kinds)
+    rendered = dict((p, -1) for p in watched)
+    renders = []
+    writers = dict((var, OutputWriter(var, run, folder, bbox=bbox, pack=pack, live=True))
+                   for var in kinds)
+
+    with ThreadPoolExecutor(max_workers=render_workers) as render_pool:
+        while True:
+            for var, kind in kinds.items():
+                if ready[var] >= last_step:
+                    continue
+                urls = list_files(var, kind, run, session, levels.get(var))
+                if len(urls) != len(manifest.variables.get(var, [])):
+                    manifest.add_variable(var, urls)
+                download_files(urls, folder, workers, session=session,
+                               manifest=manifest, checksum=False, controller=controller)
+            ready = dict((var, last_complete_step(manifest, var, run)) for var in kinds)
+
+            for product, definition in watched.items():
+                steps = [ready[var] for var in definition['variables']]
+                if min(steps) >= last_step:
+                    product_ready = last_step
+                else:
+                    product_ready = min(steps) - definition['lookahead']
+                if product_ready - rendered[product] < min_new_steps and \
+                        not (product_ready == last_step and rendered[product] < last_step):
+                    continue
+                for var in definition['variables']:
+                    if merged[var] < ready[var]:
+                        merge_variable(writers[var], run, merged[var] + 1, ready[var], manifest,
+                                       folder)
+                        merged[var] = ready[var]
+                print_message('Rendering %s for steps %d-%d' %
+                              (product, rendered[product] + 1, product_ready))
+                for projection in definition['projections']:
+                    renders.append(render_pool.submit(render, product, projection,
+                                                      rendered[product] + 1,
+                                                      product_ready, folder))
+                rendered[product] = product_ready
+
+            if all(step >= last_step for step in rendered.values()):
+                break
+            if time.time() - start > timeout:
+                print_message('Timeout reached, steps ready: %s' % ready)
+                break
+            time.sleep(interval)
+
+        # Variables which are not needed by any product are merged at the end
+        for var in kinds:
+            if merged[var] < ready[var]:
+                merge_variable(writers[var], run, merged[var] + 1, ready[var], manifest, folder)
+                merged[var] = ready[var]
+
+    failed = sum(future.result() != 0 for future in renders)
+    complete = all(step >= last_step for step in merged.values())
+    for var, writer in writers.items():
+        if merged[var] < 0:
+            writer.abort()
+            continue
+        writer.close()
+        # No render is running anymore, the file can be replaced
+        if fmt != writer.fmt:
+            ingest_variable(var, run, [os.path.join(folder, name) for name in manifest.variables[var]
+                                       if file_step(name, run) <= merged[var]],
+                            folder, fmt, bbox, pack)
+    if complete:
+        for var in kinds:
+            for name in manifest.variables[var]:
+                path = os.path.join(folder, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    return complete and failed == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run to process (YYYYMMDDHH), defaults to the one exported by copy_data.run',
+                        required=False, default=get_run_from_env())
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be downloaded',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be downloaded',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('--products', help='Download the inputs of these plotting scripts (see products.py)',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('--levels', help='Pressure levels (hPa) of 3d variables, e.g. t=500,850 fi=all, overriding the products',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-f', '--folder', help='Folder where the files are saved and the scripts are run',
+                        required=False, default='.')
+    parser.add_argument('--last_step', help='Last forecast step of the run',
+                        required=False, default=48, type=int)
+    parser.add_argument('-i', '--interval', help='Seconds between two polls of the server',
+                        required=False, default=120, type=int)
+    parser.add_argument('--timeout', help='Give up after this number of seconds',
+                        required=False, default=6 * 3600, type=int)
+    parser.add_argument('--min_new_steps', help='Render a product only when this number of new frames is ready',
+                        required=False, default=6, type=int)
+    parser.add_argument('-w', '--workers', help='Maximum number of concurrent downloads',
+                        required=False, default=16, type=int)
+    parser.add_argument('-p', '--render_workers', help='Maximum number of plotting scripts running at the same time',
+                        required=False, default=4, type=int)
+    parser.add_argument('-c', '--cities', help='Cities of the meteograms which must be kept when cropping',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('-m', '--crop_margin', help='Degrees added around the projections when cropping',
+                        required=False, default=1., type=float)
+    parser.add_argument('--no_crop', help='Keep the whole ICON-D2 domain',
+                        required=False, action='store_true')
+    parser.add_argument('--format', help='Format of the NetCDF merged files, they are written as NETCDF3 and converted once the maps are rendered',
+                        required=False, default='NETCDF3_64BIT_OFFSET',
+                        choices=['NETCDF3_64BIT_OFFSET', 'NETCDF4'])
+    parser.add_argument('--pack', help='Store the variables of packed_ranges in ingest.py as int16',
+                        required=False, action='store_true')
+    args = parser.parse_args()
+
+    if args.run is None:
+        parser.error('run not given and not found in the environment')
+
+    levels = {}
+    if args.products:
+        plan = plan_fetch(args.products)
+        levels = dict((var, l) for var, l in plan['3d'].items()
+                      if l is not None and var not in args.vars_3d)
+        args.vars_2d += [var for var in plan['2d'] if var not in args.vars_2d]
+        args.vars_3d += [var for var in plan['3d'] if var not in args.vars_3d]
+    try:
+        levels.update(parse_levels(args.levels))
+    except ValueError as e:
+        parser.error(str(e))
+    args.vars_3d += [var for var in levels if var not in args.vars_3d]
+
+    bbox = None
+    points = [get_city_coordinates(city) for city in args.cities]
+    if not args.no_crop and None not in points:
+        bbox = get_crop_bbox(points=points, margin=args.crop_margin)
+
+    success = watch_run(args.run, args.vars_2d, args.vars_3d, args.folder, args.last_step,
+                        args.interval, args.timeout, args.min_new_steps, args.workers,
+                        args.render_workers, bbox, levels, args.products or None,
+                        args.format, args.pack)
+    sys.exit(0 if success else 1)